@@ -1,65 +1,643 @@
-from flask import Flask, request, render_template_string, send_from_directory, url_for, session, jsonify
+from flask import Flask, Response, abort, g, redirect, request, render_template_string, send_file, stream_with_context, url_for, session, jsonify
 import cv2
 import numpy as np
 import os
-from itertools import product
-import requests
+import json
+import struct
+import time
+import sqlite3
+import threading
+import multiprocessing
+import uuid
+import itertools
+import gzip
+import bisect
+import tempfile
+import zipfile
+import hashlib
+import gc
+import re
+from datetime import datetime, timezone
+import click
 from werkzeug.utils import secure_filename
-from collections import defaultdict
+from werkzeug.security import safe_join
+from werkzeug.exceptions import RequestEntityTooLarge
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, Field, File, Data, Epilogue
+from collections import defaultdict, OrderedDict
+from functools import lru_cache, partial
+from contextlib import contextmanager
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FuturesTimeout, as_completed
+from concurrent.futures.process import BrokenProcessPool
 
 app = Flask(__name__)
 app.secret_key = "super_secret_key_change_this_in_prod"
 UPLOAD_FOLDER = "uploads"
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['DATABASE'] = os.environ.get("CHAMELEON_DB", "chameleon.db")
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# ──────────────────────────────
+# METRICS
+# ──────────────────────────────
+# Counters and latency histograms are updated in process memory (one lock and
+# a bisect per observation) and a background thread snapshots them to
+# METRICS_DIR/<pid>.json once a second. /metrics sums every snapshot, so the
+# numbers cover all gunicorn workers and analysis pool processes. Snapshots of
+# processes that have exited (and a stale one found under a reused pid) are
+# folded into METRICS_DIR/cumulative.json, so totals never go backwards. The
+# default directory is per instance, keyed by the database path.
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(
+    tempfile.gettempdir(),
+    "chameleon-metrics-" + hashlib.sha1(os.path.abspath(app.config['DATABASE']).encode()).hexdigest()[:12]))
+METRICS_CUMULATIVE = "cumulative.json"
+METRICS_FLUSH_INTERVAL = 1.0
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics = {"counters": defaultdict(float), "histograms": {}}
+_metrics_lock = threading.Lock()
+_metrics_pid = None
+_metrics_suspended = False
+_metrics_flush_lock = threading.Lock()
+_metrics_flushed_pid = None
+
+try:
+    import fcntl
+except ImportError:   # no flock, and os.kill(pid, 0) is no liveness probe
+    fcntl = None
+
+def _series(labels):
+    return ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+
+def _ensure_metrics_flusher():
+    global _metrics_pid
+    if _metrics_pid != os.getpid():
+        if _metrics_pid is not None:
+            # Inherited through fork: the parent reports its own numbers
+            _metrics["counters"].clear()
+            _metrics["histograms"].clear()
+        _metrics_pid = os.getpid()
+        threading.Thread(target=_flush_metrics_forever, name="metrics-flush", daemon=True).start()
+
+def inc(name, value=1, **labels):
+    if _metrics_suspended:
+        return
+    with _metrics_lock:
+        _ensure_metrics_flusher()
+        _metrics["counters"][(name, _series(labels))] += value
+
+def observe(name, seconds, **labels):
+    if _metrics_suspended:
+        return
+    with _metrics_lock:
+        _ensure_metrics_flusher()
+        key = (name, _series(labels))
+        hist = _metrics["histograms"].get(key)
+        if hist is None:
+            hist = _metrics["histograms"][key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+        hist[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        hist[-1] += seconds
+
+@contextmanager
+def metrics_suspended():
+    # Nothing is recorded (and no flush thread starts), e.g. for warm-up work
+    # in a gunicorn master that is about to fork
+    global _metrics_suspended
+    _metrics_suspended = True
+    try:
+        yield
+    finally:
+        _metrics_suspended = False
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("chameleon_stage_seconds", time.perf_counter() - start, stage=stage)
+
+def _metrics_snapshot():
+    with _metrics_lock:
+        return {
+            "counters": [[n, l, v] for (n, l), v in _metrics["counters"].items()],
+            "histograms": [[n, l, list(h)] for (n, l), h in _metrics["histograms"].items()],
+        }
+
+def _write_snapshot(path, snapshot):
+    with open(path + ".tmp", "w") as f:
+        json.dump(snapshot, f)
+    os.replace(path + ".tmp", path)
+
+def _add_snapshot(counters, histograms, snapshot):
+    for n, l, v in snapshot["counters"]:
+        counters[(n, l)] += v
+    for n, l, h in snapshot["histograms"]:
+        total = histograms.setdefault((n, l), [0] * len(h))
+        for i, v in enumerate(h):
+            total[i] += v
+
+@contextmanager
+def _metrics_dir_locked():
+    # Serializes folding and aggregation across processes
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with open(os.path.join(METRICS_DIR, ".lock"), "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _fold_metrics(paths):
+    # Adds the given snapshots to the cumulative one and removes them; the
+    # caller holds _metrics_dir_locked()
+    if not paths:
+        return
+    counters, histograms = defaultdict(float), {}
+    cumulative = os.path.join(METRICS_DIR, METRICS_CUMULATIVE)
+    for path in [cumulative] + paths:
+        try:
+            with open(path) as f:
+                _add_snapshot(counters, histograms, json.load(f))
+        except (OSError, ValueError):
+            continue
+    _write_snapshot(cumulative, {
+        "counters": [[n, l, v] for (n, l), v in counters.items()],
+        "histograms": [[n, l, h] for (n, l), h in histograms.items()],
+    })
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def flush_metrics():
+    global _metrics_flushed_pid
+    with _metrics_flush_lock:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+        if _metrics_flushed_pid != os.getpid():
+            # Anything already under this pid was written by an exited process
+            if os.path.exists(path):
+                with _metrics_dir_locked():
+                    _fold_metrics([path])
+            _metrics_flushed_pid = os.getpid()
+        _write_snapshot(path, _metrics_snapshot())
+
+def _flush_metrics_forever():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush_metrics()
+        except OSError as e:
+            print(f"Metrics flush failed: {e}")
+
+def _metrics_files():
+    return [name for name in os.listdir(METRICS_DIR) if name.endswith(".json")]
+
+def aggregate_metrics():
+    counters, histograms = defaultdict(float), {}
+    with _metrics_dir_locked():
+        if fcntl is not None:
+            _fold_metrics([os.path.join(METRICS_DIR, name) for name in _metrics_files()
+                           if name[:-5].isdigit() and not _pid_alive(int(name[:-5]))])
+        for name in _metrics_files():
+            try:
+                with open(os.path.join(METRICS_DIR, name)) as f:
+                    _add_snapshot(counters, histograms, json.load(f))
+            except (OSError, ValueError):
+                continue
+    return counters, histograms
+
+def render_metrics(counters, histograms):
+    lines = []
+    for name in sorted({n for n, _ in counters}):
+        lines.append(f"# TYPE {name} counter")
+        for (n, l), v in sorted(counters.items()):
+            if n == name:
+                lines.append(f"{n}{{{l}}} {v:g}" if l else f"{n} {v:g}")
+    for name in sorted({n for n, _ in histograms}):
+        lines.append(f"# TYPE {name} histogram")
+        for (n, l), h in sorted(histograms.items()):
+            if n != name:
+                continue
+            prefix = f"{l}," if l else ""
+            cumulative = 0
+            for le, count in zip(LATENCY_BUCKETS + ("+Inf",), h[:-1]):
+                cumulative += count
+                lines.append(f'{n}_bucket{{{prefix}le="{le}"}} {cumulative}')
+            lines.append(f"{n}_sum{{{l}}} {h[-1]:.6f}" if l else f"{n}_sum {h[-1]:.6f}")
+            lines.append(f"{n}_count{{{l}}} {cumulative}" if l else f"{n}_count {cumulative}")
+    return "\n".join(lines) + "\n"
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _record_request(response):
+    started = g.pop("request_started", None)
+    if started is not None and request.endpoint != "metrics":
+        observe("chameleon_request_seconds", time.perf_counter() - started, endpoint=request.endpoint or "unknown")
+        inc("chameleon_requests_total", endpoint=request.endpoint or "unknown", status=response.status_code)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    flush_metrics()
+    return Response(render_metrics(*aggregate_metrics()), mimetype="text/plain; version=0.0.4")
+
 # Upload route
+# ?size=N serves a cached thumbnail (WebP when the browser accepts it, JPEG
+# otherwise) that fits in N x N. Responses carry strong ETags and answer
+# conditional requests with 304.
+THUMB_SIZES = (160, 320, 640)
+THUMB_DEFAULT = 320   # results show images at 140 CSS px; 320 covers 2x screens
+app.config['UPLOAD_MAX_AGE'] = int(os.environ.get("UPLOAD_MAX_AGE", 7 * 24 * 3600))
+
+def make_thumbnail(src, dst, size):
+    with open(src, "rb") as f:
+        data = f.read()
+    flags = cv2.IMREAD_COLOR
+    dims = image_size(data)
+    if dims:
+        for factor, mode in REDUCED_MODES:
+            if max(dims) // factor >= size:
+                flags = mode
+                break
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), flags) if data else None
+    if img is None:
+        return False
+    h, w = img.shape[:2]
+    scale = size / max(h, w)
+    if scale < 1:
+        img = cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+    ext = os.path.splitext(dst)[1]
+    params = [cv2.IMWRITE_WEBP_QUALITY, 80] if ext == ".webp" else [cv2.IMWRITE_JPEG_QUALITY, 82]
+    ok, buf = cv2.imencode(ext, img, params)
+    if not ok:
+        return False
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    # gthread workers can render the same thumbnail concurrently
+    tmp = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+    write_file(tmp, buf.tobytes())
+    os.replace(tmp, dst)
+    return True
+
+# Store keys (see UPLOAD STORE) name their content, so those responses are
+# cacheable forever; legacy flat files keep UPLOAD_MAX_AGE.
 @app.route('/uploads/<filename>', endpoint='uploaded_file')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    size = request.args.get('size', type=int)
+    if size is not None and size not in THUMB_SIZES:
+        return jsonify({"error": f"size must be one of {list(THUMB_SIZES)}"}), 400
+    src = uploads.resolve(filename)
+    immutable = src is not None
+    if immutable:
+        max_age = IMMUTABLE_MAX_AGE
+    else:
+        max_age = app.config['UPLOAD_MAX_AGE']
+        src = safe_join(app.config['UPLOAD_FOLDER'], filename)
+        if src is None or not os.path.isfile(src):
+            abort(404)
+    if size is None:
+        response = send_file(os.path.abspath(src), max_age=max_age, conditional=True, etag=True)
+    else:
+        # Only an explicit image/webp counts: `in` would also match */* and image/*
+        webp = any(m == "image/webp" and q > 0 for m, q in request.accept_mimetypes)
+        ext = ".webp" if webp else ".jpg"
+        if immutable:
+            thumb = uploads.thumb_path(filename, size, ext)
+        else:
+            thumb = os.path.join(app.config['UPLOAD_FOLDER'], ".thumbs", str(size), filename + ext)
+        made = os.path.exists(thumb) and os.path.getmtime(thumb) >= os.path.getmtime(src)
+        if not made:
+            with timed("thumbnail"):
+                made = make_thumbnail(src, thumb, size)
+        response = send_file(os.path.abspath(thumb if made else src), max_age=max_age, conditional=True, etag=True)
+        response.vary.add("Accept")
+    if immutable:
+        response.cache_control.immutable = True
+    return response
 
 # ──────────────────────────────
 # Sanzo Wada loading
 # ──────────────────────────────
+# The dataset is read from a local cache (a few ms) instead of being fetched
+# from GitHub at import time. data/sanzo.json ships with the code, so new
+# instances never depend on GitHub: `flask --app app refresh-sanzo` rebuilds
+# it, and the result is committed (or the command runs in the image build).
+# Only if the file is missing anyway is it fetched, off the import path:
+# gunicorn's when_ready does it in the master before forking, otherwise the
+# first request in each process starts a background fetch (retried every
+# SANZO_RETRY_INTERVAL seconds). Until then pairings report "Sanzo data
+# unavailable".
+SANZO_URL = "https://raw.githubusercontent.com/mattdesl/dictionary-of-colour-combinations/master/colors.json"
+SANZO_CACHE = os.environ.get("SANZO_CACHE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "sanzo.json"))
+SANZO_CACHE_FORMAT = 1
+SANZO_RETRY_INTERVAL = 300
+
 SANZO_COLORS = []
 SANZO_PALETTES = {}
+SANZO_VERSION = None
+
+def group_sanzo_palettes(colors):
+    # One pass over the colors; palettes keep dataset order like the old per-id scans
+    palettes = defaultdict(list)
+    for i, c in enumerate(colors):
+        for pid in dict.fromkeys(c.get('combinations', [])):
+            palettes[pid].append(i)
+    return {pid: palettes[pid] for pid in sorted(palettes)}
+
+def build_sanzo_cache(raw, source):
+    colors = [{'name': c['name'], 'hex': c['hex'], 'combinations': c.get('combinations', [])}
+              for c in json.loads(raw)]
+    return {
+        "format": SANZO_CACHE_FORMAT,
+        "version": hashlib.sha256(raw).hexdigest()[:16],
+        "source": source,
+        "fetched_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "colors": colors,
+        "palettes": group_sanzo_palettes(colors),
+    }
 
-try:
-    url = "https://raw.githubusercontent.com/mattdesl/dictionary-of-colour-combinations/master/colors.json"
-    response = requests.get(url, timeout=10)
-    response.raise_for_status()
-    SANZO_COLORS = response.json()
-except Exception as e:
-    print(f"Sanzo load failed: {e}")
-
-if SANZO_COLORS:
-    for pid in range(1, 349):
-        palette = [c for c in SANZO_COLORS if pid in c.get('combinations', [])]
-        if palette:
-            SANZO_PALETTES[pid] = [{'name': c['name'], 'hex': c['hex']} for c in palette]
+def write_sanzo_cache(cache, path=SANZO_CACHE):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(cache, f, separators=(",", ":"))
+    os.replace(tmp, path)
+
+def load_sanzo(path=SANZO_CACHE):
+    global SANZO_VERSION
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+        colors = cache["colors"]
+        if cache.get("format") == SANZO_CACHE_FORMAT:
+            grouped = {int(pid): idx for pid, idx in cache["palettes"].items()}
+        else:
+            grouped = group_sanzo_palettes(colors)
+        palettes = {pid: [{'name': colors[i]['name'], 'hex': colors[i]['hex']} for i in idx]
+                    for pid, idx in grouped.items()}
+    except FileNotFoundError:
+        print(f"Sanzo cache {path} missing; it will be fetched from {SANZO_URL}")
+        return False
+    except Exception as e:
+        # A malformed cache must not stop the app from starting
+        print(f"Sanzo load failed: {e!r}")
+        return False
+    SANZO_COLORS[:] = colors
+    SANZO_PALETTES.clear()
+    SANZO_PALETTES.update(palettes)
+    SANZO_VERSION = cache.get("version")
+    return True
+
+load_sanzo()
+
+_sanzo_fetch_lock = threading.Lock()
+_sanzo_fetched_at = None
+
+def fetch_sanzo(source=SANZO_URL):
+    if os.path.exists(source):
+        with open(source, "rb") as f:
+            raw = f.read()
+    else:
+        import requests
+        response = requests.get(source, timeout=10)
+        response.raise_for_status()
+        raw = response.content
+    write_sanzo_cache(build_sanzo_cache(raw, source))
+
+def reload_sanzo():
+    # Loads the cache and rebuilds everything derived from the dataset
+    if not load_sanzo():
+        return False
+    build_sanzo_index()
+    pair_score.cache_clear()
+    ANALYSIS_VERSIONS["color"] = color_analysis_version()
+    # Pool processes imported the old data; new ones load the cache
+    _reset_analysis_pool(cancel=False)
+    return True
+
+def _fetch_missing_sanzo():
+    try:
+        if not os.path.exists(SANZO_CACHE):   # another process may have written it
+            fetch_sanzo()
+        reload_sanzo()
+    except Exception as e:
+        print(f"Sanzo fetch failed: {e}")
+
+def ensure_sanzo(wait=False):
+    global _sanzo_fetched_at
+    if SANZO_VERSION is not None:
+        return
+    with _sanzo_fetch_lock:
+        now = time.monotonic()
+        if _sanzo_fetched_at is not None and now - _sanzo_fetched_at < SANZO_RETRY_INTERVAL:
+            return
+        _sanzo_fetched_at = now
+    if wait:
+        _fetch_missing_sanzo()
+    else:
+        threading.Thread(target=_fetch_missing_sanzo, name="sanzo-fetch", daemon=True).start()
+
+@app.before_request
+def _ensure_sanzo():
+    ensure_sanzo()
+
+@app.cli.command("refresh-sanzo")
+@click.option("--source", default=SANZO_URL, show_default=True,
+              help="URL or local path of the dictionary-of-colour-combinations colors.json")
+def refresh_sanzo(source):
+    """Download the Sanzo Wada dataset and rebuild the local cache."""
+    fetch_sanzo(source)
+    reload_sanzo()
+    click.echo(f"Sanzo cache {SANZO_CACHE}: {len(SANZO_COLORS)} colors, "
+               f"{len(SANZO_PALETTES)} palettes, version {SANZO_VERSION}")
 
 # ──────────────────────────────
 # COLOR LOGIC FUNCTIONS
 # ──────────────────────────────
+# Reduced decode: JPEGs are downscaled by 1/2, 1/4 or 1/8 inside the decoder,
+# so a 12 MP photo never has to be fully decoded just to be resized.
+REDUCED_MODES = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+def image_size(data):
+    # (width, height) from a PNG or JPEG header; None for anything else
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        return struct.unpack(">II", data[16:24])
+    if data[:2] != b'\xff\xd8':
+        return None
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if 0xD0 <= marker <= 0xD9 or marker == 0x01:
+            i += 2
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            h, w = struct.unpack(">HH", data[i + 5:i + 9])
+            return w, h
+        i += 2 + struct.unpack(">H", data[i + 2:i + 4])[0]
+    return None
+
+def load_image(src, size):
+    # src is a path or the raw upload bytes; returns a BGR image resized to size
+    if isinstance(src, str):
+        with open(src, "rb") as f:
+            src = f.read()
+    if not src:
+        return None
+    flags = cv2.IMREAD_COLOR
+    dims = image_size(src)
+    if dims:
+        for factor, mode in REDUCED_MODES:
+            if min(dims) // factor >= max(size):
+                flags = mode
+                break
+    with timed("decode"):
+        img = cv2.imdecode(np.frombuffer(src, np.uint8), flags)
+    inc("chameleon_bytes_decoded_total", len(src))
+    if img is None:
+        return None
+    with timed("resize"):
+        return cv2.resize(img, size)
+
+def write_file(path, data):
+    with timed("file_save"), open(path, "wb") as f:
+        f.write(data)
+
+# Uploads are written by a small thread pool while the request thread runs the
+# analysis. Created lazily so each (forked) worker process gets its own.
+_io_pool = None
+_io_pool_pid = None
+
+def io_pool():
+    global _io_pool, _io_pool_pid
+    if _io_pool is None or _io_pool_pid != os.getpid():
+        _io_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="upload-io")
+        _io_pool_pid = os.getpid()
+    return _io_pool
+
+SKIN_HSV_LOWER = (0, 30, 60)
+SKIN_HSV_UPPER = (20, 170, 255)
+SKIN_TONE_LEVELS = ((180, "Fair"), (140, "Medium"), (100, "Olive"))
+
 def get_skin_mask(img):
     hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-    return cv2.inRange(hsv, (0, 30, 60), (20, 170, 255))
+    return cv2.inRange(hsv, SKIN_HSV_LOWER, SKIN_HSV_UPPER)
 
-def detect_skin_tone(path):
-    img = cv2.imread(path)
+def detect_skin_tone(src):
+    img = load_image(src, (200, 200))
+    inc("chameleon_images_processed_total", kind="skin")
     if img is None:
         return "Unknown"
-    img = cv2.resize(img, (200, 200))
-    mask = get_skin_mask(img)
-    skin = img[mask > 0]
+    with timed("mask"):
+        mask = get_skin_mask(img)
+        skin = img[mask > 0]
     if len(skin) == 0:
         return "Unknown"
-    brightness = np.mean(skin)
-    if brightness > 180: return "Fair"
-    if brightness > 140: return "Medium"
-    if brightness > 100: return "Olive"
+    with timed("classify"):
+        brightness = np.mean(skin)
+    return skin_tone_for(brightness)
+
+def skin_tone_for(brightness):
+    for level, tone in SKIN_TONE_LEVELS:
+        if brightness > level:
+            return tone
     return "Dark"
 
+# Optional face region: the largest frontal face found by OpenCV's Haar
+# cascade, shrunk to skip hair and background. FACE_CASCADE overrides the
+# cascade file; without one (some OpenCV builds ship none) frames are masked
+# whole.
+FACE_CASCADE = os.environ.get("FACE_CASCADE") or os.path.join(
+    getattr(getattr(cv2, "data", None), "haarcascades", ""), "haarcascade_frontalface_default.xml")
+
+@lru_cache(maxsize=1)
+def face_detector():
+    if not os.path.exists(FACE_CASCADE):
+        return None
+    detector = cv2.CascadeClassifier(FACE_CASCADE)
+    return None if detector.empty() else detector
+
+def face_region(img):
+    detector = face_detector()
+    if detector is None:
+        return None
+    with timed("face_detect"):
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        faces = detector.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=4, minSize=(40, 40))
+    if len(faces) == 0:
+        return None
+    x, y, w, h = max(faces, key=lambda f: f[2] * f[3])
+    return x + w // 6, y + h // 6, w * 2 // 3, h * 2 // 3
+
+def skin_brightness(img, face=False):
+    # (mean skin brightness, skin pixels, face region or None) of one frame,
+    # or None when it has no skin pixels
+    region = face_region(img) if face else None
+    if region is not None:
+        x, y, w, h = region
+        img = img[y:y + h, x:x + w]
+    with timed("mask"):
+        skin = img[get_skin_mask(img) > 0]
+    if len(skin) == 0:
+        return None
+    return float(np.mean(skin)), len(skin), region
+
+# Multi-frame estimate: each frame's mean skin brightness is one sample of a
+# running (Welford) mean and variance. It is stable once the 95% interval of
+# the mean lies inside one SKIN_TONE_LEVELS band, or is narrower than
+# SKIN_STREAM_TOLERANCE, after at least SKIN_STREAM_MIN_FRAMES frames.
+SKIN_STREAM_MIN_FRAMES = 3
+SKIN_STREAM_MAX_FRAMES = 30
+SKIN_STREAM_Z = 1.96
+SKIN_STREAM_TOLERANCE = 3.0
+
+class SkinToneEstimate:
+    def __init__(self, n=0, mean=0.0, m2=0.0):
+        self.n, self.mean, self.m2 = n, mean, m2
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def half_width(self):
+        if self.n < 2:
+            return float("inf")
+        return SKIN_STREAM_Z * (self.m2 / (self.n - 1) / self.n) ** 0.5
+
+    def tone(self):
+        return skin_tone_for(self.mean) if self.n else "Unknown"
+
+    def stable(self):
+        if self.n < SKIN_STREAM_MIN_FRAMES:
+            return False
+        h = self.half_width()
+        return h <= SKIN_STREAM_TOLERANCE or skin_tone_for(self.mean - h) == skin_tone_for(self.mean + h)
+
+    def done(self):
+        return self.stable() or self.n >= SKIN_STREAM_MAX_FRAMES
+
+    def state(self):
+        return [self.n, self.mean, self.m2]
+
 COLOR_DB = {
     "Black": (20,20,20), "White": (240,240,240),
     "Navy": (20,40,80), "Blue": (60,100,180),
@@ -68,18 +646,110 @@ COLOR_DB = {
     "Mustard": (205,173,0), "Red": (160,40,40)
 }
 
-def dominant_color(path):
-    img = cv2.imread(path)
+# Reference palette as one array, matched with a single broadcast distance.
+COLOR_NAMES = list(COLOR_DB)
+COLOR_REFS = np.array([COLOR_DB[n] for n in COLOR_NAMES], dtype=np.float32)
+COLOR_MAX_DIST = 70
+COLOR_LUT_BITS = 5   # 32 bins per channel
+
+def build_color_lut(refs, bits=COLOR_LUT_BITS, max_dist=COLOR_MAX_DIST, transform=None):
+    # Quantized BGR -> color id (-1 = too far from every reference). Distances
+    # are taken from each bin centre, so the cost is independent of the size of
+    # the color database once built. `transform` maps the BGR bin centres into
+    # the space `refs` live in (e.g. bgr_to_lab).
+    step = 256 >> bits
+    centers = np.arange(1 << bits, dtype=np.float32) * step + (step - 1) / 2
+    grid = np.stack(np.meshgrid(centers, centers, centers, indexing='ij'), -1).reshape(-1, 3)
+    if transform is not None:
+        grid = transform(grid)
+    d2 = (grid ** 2).sum(1)[:, None] + (refs ** 2).sum(1)[None, :] - 2 * grid @ refs.T
+    ids = np.argmin(d2, axis=1)
+    ids[d2[np.arange(len(grid)), ids] >= max_dist ** 2] = -1
+    return ids.astype(np.int16).reshape((1 << bits,) * 3)
+
+COLOR_LUT = build_color_lut(COLOR_REFS) if os.environ.get("COLOR_LUT") == "1" else None
+
+def nearest_color(avg, refs=None, max_dist=COLOR_MAX_DIST, lut=None):
+    # refs defaults to the current COLOR_REFS (it may be swapped for a frozen copy)
+    refs = COLOR_REFS if refs is None else refs
+    if lut is not None:
+        shift = 8 - (lut.shape[0] - 1).bit_length()
+        b, g, r = np.clip(avg, 0, 255).astype(np.uint8) >> shift
+        return int(lut[b, g, r])
+    d = np.linalg.norm(refs - np.asarray(avg, dtype=np.float32), axis=1)
+    i = int(np.argmin(d))
+    return i if d[i] < max_dist else -1
+
+def classify_color(avg, names=COLOR_NAMES, refs=None, lut=None):
+    i = nearest_color(avg, refs, lut=lut)
+    return names[i] if i >= 0 else "Uncertain"
+
+# Perceptual matching: with COLOR_MATCHING=sanzo (the default whenever Sanzo
+# data is loaded) a garment's mean color is matched to the nearest Sanzo color
+# by CIE76 delta E in Lab, and that color's name becomes the garment color.
+# Pairing then uses exact palette membership. Each Sanzo color also maps to its
+# nearest COLOR_DB family so the skin-tone RULES keep working.
+app.config['COLOR_MATCHING'] = os.environ.get("COLOR_MATCHING", "sanzo")
+SANZO_MAX_DELTA_E = 40
+
+SANZO_NAMES = []
+SANZO_NAME_INDEX = {}   # lowercased name -> index
+SANZO_BGR = np.zeros((0, 3), np.float32)
+SANZO_LAB = np.zeros((0, 3), np.float32)
+SANZO_FAMILY = {}       # Sanzo name -> COLOR_DB name
+SANZO_LUT = None
+
+def hex_to_bgr(value):
+    value = value.lstrip('#')
+    return int(value[4:6], 16), int(value[2:4], 16), int(value[0:2], 16)
+
+def bgr_to_lab(bgr):
+    bgr = np.asarray(bgr, dtype=np.float32).reshape(-1, 1, 3) / 255
+    return cv2.cvtColor(bgr, cv2.COLOR_BGR2Lab).reshape(-1, 3)
+
+def build_sanzo_colors():
+    global SANZO_NAMES, SANZO_NAME_INDEX, SANZO_BGR, SANZO_LAB, SANZO_FAMILY, SANZO_LUT
+    SANZO_NAMES = [c['name'] for c in SANZO_COLORS]
+    SANZO_NAME_INDEX = {}
+    for i, name in enumerate(SANZO_NAMES):
+        SANZO_NAME_INDEX.setdefault(name.lower(), i)
+    SANZO_BGR = np.array([hex_to_bgr(c['hex']) for c in SANZO_COLORS], dtype=np.float32).reshape(-1, 3)
+    SANZO_LAB = bgr_to_lab(SANZO_BGR) if len(SANZO_BGR) else np.zeros((0, 3), np.float32)
+    SANZO_FAMILY = {name: COLOR_NAMES[int(np.argmin(np.linalg.norm(COLOR_REFS - bgr, axis=1)))]
+                    for name, bgr in zip(SANZO_NAMES, SANZO_BGR)}
+    SANZO_LUT = None
+    if COLOR_LUT is not None and len(SANZO_LAB):
+        SANZO_LUT = build_color_lut(SANZO_LAB, max_dist=SANZO_MAX_DELTA_E, transform=bgr_to_lab)
+
+def sanzo_matching():
+    return app.config['COLOR_MATCHING'] == "sanzo" and len(SANZO_NAMES) > 0
+
+def nearest_sanzo_color(avg):
+    if SANZO_LUT is not None:
+        i = nearest_color(avg, lut=SANZO_LUT)
+    else:
+        i = nearest_color(bgr_to_lab(avg)[0], SANZO_LAB, SANZO_MAX_DELTA_E)
+    return SANZO_NAMES[i] if i >= 0 else "Uncertain"
+
+def color_family(color):
+    return color if color in COLOR_DB else SANZO_FAMILY.get(color, color)
+
+def color_bgr(color):
+    if color in COLOR_DB:
+        return COLOR_REFS[COLOR_NAMES.index(color)]
+    i = SANZO_NAME_INDEX.get(color.lower())
+    return None if i is None else SANZO_BGR[i]
+
+def dominant_color(src):
+    img = load_image(src, (150, 150))
+    inc("chameleon_images_processed_total", kind="color")
     if img is None:
         return "Uncertain"
-    img = cv2.resize(img, (150,150))
-    avg = np.mean(img.reshape(-1,3), axis=0)
-    best, dist = None, 1e9
-    for name, ref in COLOR_DB.items():
-        d = np.linalg.norm(avg - np.array(ref))
-        if d < dist:
-            best, dist = name, d
-    return best if dist < 70 else "Uncertain"
+    with timed("classify"):
+        avg = cv2.mean(img)[:3]
+        if sanzo_matching():
+            return nearest_sanzo_color(avg)
+        return classify_color(avg, lut=COLOR_LUT)
 
 RULES = {
     "Fair": ["Navy", "Blue"],
@@ -95,42 +765,1118 @@ FACE_SHAPE_RULES = {
     "Rectangular": "Contrast tops balance face length"
 }
 
+# Palette index: color token -> [(size, hexes, pid), ...] ranked best first.
+# Built once at load time; tokens outside COLOR_DB are indexed on first use.
+# Exact Sanzo color names match the palettes that contain that color; any
+# other token matches by substring as before.
+SANZO_PALETTE_INDEX = {}
+
+def _rank_palettes(token):
+    if token in SANZO_NAME_INDEX:
+        matches = lambda name: name == token
+    else:
+        matches = lambda name: token in name
+    ranked = []
+    for pid, palette in SANZO_PALETTES.items():
+        if any(matches(c['name'].lower()) for c in palette):
+            ranked.append((len(palette), [c['hex'] for c in palette], pid))
+    ranked.sort(reverse=True)
+    return ranked
+
+def palettes_for_color(color):
+    token = color.lower()
+    ranked = SANZO_PALETTE_INDEX.get(token)
+    if ranked is None:
+        ranked = SANZO_PALETTE_INDEX[token] = _rank_palettes(token)
+    return ranked
+
+def build_sanzo_index():
+    build_sanzo_colors()
+    SANZO_PALETTE_INDEX.clear()
+    find_best_sanzo_palette.cache_clear()
+    for name in COLOR_DB:
+        palettes_for_color(name)
+    for name in SANZO_NAME_INDEX:
+        palettes_for_color(name)
+
+@lru_cache(maxsize=4096)
 def find_best_sanzo_palette(top_color, bottom_color):
     if not SANZO_PALETTES:
         return ["#cccccc", "#aaaaaa"], "Sanzo data unavailable"
-    candidates = []
-    for pid, palette in SANZO_PALETTES.items():
-        names = [c['name'].lower() for c in palette]
-        if any(top_color.lower() in n or bottom_color.lower() in n for n in names):
-            hexes = [c['hex'] for c in palette]
-            candidates.append((len(palette), hexes, pid))
-    if candidates:
-        candidates.sort(reverse=True)
-        _, hexes, pid = candidates[0]
+    top_ranked, bottom_ranked = palettes_for_color(top_color), palettes_for_color(bottom_color)
+    if top_color.lower() in SANZO_NAME_INDEX and bottom_color.lower() in SANZO_NAME_INDEX:
+        # Both are Sanzo colors: prefer the largest palette that holds both
+        bottom_pids = {pid for _, _, pid in bottom_ranked}
+        shared = next((r for r in top_ranked if r[2] in bottom_pids), None)
+        if shared:
+            return shared[1], f"Sanzo Wada Palette #{shared[2]}"
+    heads = [r[0] for r in (top_ranked, bottom_ranked) if r]
+    if heads:
+        _, hexes, pid = max(heads)
         return hexes, f"Sanzo Wada Palette #{pid}"
     return ["#e0d4b8", "#a68a64"], "Natural tones"
 
-# 🔧 FIXED: preserve all clothes (NO LOGIC CHANGE)
-def generate_all_pairings(skin_tone, face_shape, tops_dict, bottoms_dict):
-    preferred_tops = [c for c in tops_dict if c in RULES.get(skin_tone, [])]
-    if not preferred_tops:
-        preferred_tops = list(tops_dict.keys())
-
-    pairings = []
-    for top in preferred_tops:
-        for bottom in bottoms_dict:
-            for top_img in tops_dict[top]:
-                for bottom_img in bottoms_dict[bottom]:
-                    palette_colors, sanzo_note = find_best_sanzo_palette(top, bottom)
-                    pairings.append({
-                        "top_color": top,
-                        "top_img": url_for('uploaded_file', filename=os.path.basename(top_img)),
-                        "bottom_color": bottom,
-                        "bottom_img": url_for('uploaded_file', filename=os.path.basename(bottom_img)),
-                        "reason": f"{top} suits {skin_tone} skin • {FACE_SHAPE_RULES.get(face_shape)} • {sanzo_note}",
-                        "palette_colors": palette_colors
-                    })
-    return pairings
+build_sanzo_index()
+
+# Ranked mode: every (top color, bottom color) group gets one score, so the
+# cost grows with the number of distinct colors, not with the number of images.
+PAIR_SCORE_WEIGHTS = {"preference": 0.5, "palette": 0.3, "contrast": 0.2}
+MAX_BGR_DISTANCE = float(np.linalg.norm([255, 255, 255]))
+
+def palette_match_strength(top_color, bottom_color):
+    # 1.0 when one Sanzo palette holds both colors, 0.5 when only one color is
+    # in any palette, 0 otherwise
+    top_pids = {pid for _, _, pid in palettes_for_color(top_color)}
+    bottom_pids = {pid for _, _, pid in palettes_for_color(bottom_color)}
+    if top_pids & bottom_pids:
+        return 1.0
+    return 0.5 if top_pids or bottom_pids else 0.0
+
+@lru_cache(maxsize=4096)
+def pair_score(skin_tone, top_color, bottom_color):
+    preference = 1.0 if color_family(top_color) in RULES.get(skin_tone, []) else 0.0
+    contrast = 0.0
+    top_bgr, bottom_bgr = color_bgr(top_color), color_bgr(bottom_color)
+    if top_bgr is not None and bottom_bgr is not None:
+        contrast = np.linalg.norm(top_bgr - bottom_bgr) / MAX_BGR_DISTANCE
+    w = PAIR_SCORE_WEIGHTS
+    return round(w["preference"] * preference + w["palette"] * palette_match_strength(top_color, bottom_color)
+                 + w["contrast"] * float(contrast), 4)
+
+def counted_pairings(pairings):
+    # Times the whole (possibly streamed) generation and counts what was emitted
+    count = 0
+    with timed("pairing"):
+        for pairing in pairings:
+            count += 1
+            yield pairing
+    inc("chameleon_pairings_emitted_total", count)
+
+# ──────────────────────────────
+# SHARED SQLITE STORE
+# ──────────────────────────────
+# One connection per thread and process; WAL lets every gunicorn worker read
+# while another one writes.
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS analysis (
+    kind TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    version TEXT NOT NULL,
+    result TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (kind, digest)
+);
+"""
+
+# Columns added to existing tables after they were first shipped
+DB_MIGRATIONS = []   # (table, column, declaration)
+
+_db_local = threading.local()
+
+def _migrate(conn):
+    for table, column, declaration in DB_MIGRATIONS:
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        if column not in columns:
+            try:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+            except sqlite3.OperationalError as e:
+                if "duplicate column" not in str(e):   # another worker added it first
+                    raise
+
+def get_db():
+    conn = getattr(_db_local, "conn", None)
+    if conn is None or _db_local.pid != os.getpid():
+        conn = sqlite3.connect(app.config['DATABASE'], timeout=10, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(DB_SCHEMA)
+        _migrate(conn)
+        _db_local.conn, _db_local.pid = conn, os.getpid()
+    return conn
+
+# ──────────────────────────────
+# ANALYSIS CACHE
+# ──────────────────────────────
+# Results are keyed by the image's content hash. A bounded in-process LRU sits
+# in front of the SQLite table shared by all workers. Each entry records the
+# version of the algorithm that produced it, derived from the thresholds and
+# reference colors, so changing them invalidates old entries.
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _algo_version(*parts):
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:12]
+
+def color_analysis_version():
+    return _algo_version(1, COLOR_DB, COLOR_MAX_DIST, COLOR_LUT is not None and COLOR_LUT_BITS,
+                         sanzo_matching() and (SANZO_VERSION, SANZO_MAX_DELTA_E))
+
+ANALYSIS_VERSIONS = {
+    "skin": _algo_version(1, SKIN_HSV_LOWER, SKIN_HSV_UPPER, SKIN_TONE_LEVELS),
+    "color": color_analysis_version(),
+}
+ANALYSIS_CACHE_SIZE = int(os.environ.get("ANALYSIS_CACHE_SIZE", 4096))
+ANALYSIS_CACHE_STATS = {"hits": 0, "disk_hits": 0, "misses": 0}
+
+_analysis_lru = OrderedDict()
+_analysis_lock = threading.Lock()
+
+def _remember(key, result):
+    with _analysis_lock:
+        _analysis_lru[key] = result
+        _analysis_lru.move_to_end(key)
+        while len(_analysis_lru) > ANALYSIS_CACHE_SIZE:
+            _analysis_lru.popitem(last=False)
+
+def cache_lookup(kind, digest):
+    key = (kind, digest, ANALYSIS_VERSIONS[kind])
+    with _analysis_lock:
+        if key in _analysis_lru:
+            _analysis_lru.move_to_end(key)
+            ANALYSIS_CACHE_STATS["hits"] += 1
+            inc("chameleon_analysis_cache_total", kind=kind, result="hit")
+            return _analysis_lru[key]
+    try:
+        row = get_db().execute("SELECT result FROM analysis WHERE kind = ? AND digest = ? AND version = ?",
+                               key).fetchone()
+    except sqlite3.Error as e:
+        print(f"Analysis cache read failed: {e}")
+        row = None
+    if row is None:
+        return None
+    result = json.loads(row[0])
+    ANALYSIS_CACHE_STATS["disk_hits"] += 1
+    inc("chameleon_analysis_cache_total", kind=kind, result="disk_hit")
+    _remember(key, result)
+    return result
+
+def cache_store(kind, digest, result):
+    version = ANALYSIS_VERSIONS[kind]
+    ANALYSIS_CACHE_STATS["misses"] += 1
+    inc("chameleon_analysis_cache_total", kind=kind, result="miss")
+    try:
+        get_db().execute("INSERT OR REPLACE INTO analysis VALUES (?, ?, ?, ?, ?)",
+                         (kind, digest, version, json.dumps(result), time.time()))
+    except sqlite3.Error as e:
+        print(f"Analysis cache write failed: {e}")
+    _remember((kind, digest, version), result)
+
+def cached_analysis(kind, data, fn, digest=None):
+    digest = digest or content_hash(data)
+    result = cache_lookup(kind, digest)
+    if result is None:
+        result = fn(data)
+        cache_store(kind, digest, result)
+    return result
+
+# ──────────────────────────────
+# ANALYSIS POOL
+# ──────────────────────────────
+# Batches of uploads are analysed on a process pool sized to the available
+# cores. The pool is created lazily once per gunicorn worker and reused;
+# ANALYSIS_WORKERS=0 analyses sequentially in the request thread instead.
+_cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+app.config['ANALYSIS_WORKERS'] = int(os.environ.get("ANALYSIS_WORKERS", _cores if _cores > 1 else 0))
+app.config['ANALYSIS_TIMEOUT'] = float(os.environ.get("ANALYSIS_TIMEOUT", 30))
+
+_analysis_pool = None
+_analysis_pool_pid = None
+_analysis_pool_lock = threading.Lock()
+
+def _init_analysis_process():
+    # One OpenCV thread per pool process; the pool itself provides the parallelism
+    cv2.setNumThreads(1)
+
+def analysis_pool():
+    global _analysis_pool, _analysis_pool_pid
+    workers = app.config['ANALYSIS_WORKERS']
+    if workers <= 0:
+        return None
+    # Request threads race here; a second pool would orphan the first
+    with _analysis_pool_lock:
+        if _analysis_pool is None or _analysis_pool_pid != os.getpid():
+            _analysis_pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_analysis_process,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+            _analysis_pool_pid = os.getpid()
+        return _analysis_pool
+
+def _reset_analysis_pool(pool=None, terminate=False, cancel=True):
+    # Retires `pool` only while it is still the current one (None: whichever
+    # is current), so batches that all saw the same pool fail cannot shut
+    # down the fresh pool another thread has since created.
+    # terminate=True also kills processes still busy with a task (a hung
+    # analysis would otherwise keep its slot forever); other batches in
+    # flight on this pool then fail over to their fallback results.
+    # cancel=False lets queued tasks finish on the old processes.
+    global _analysis_pool
+    with _analysis_pool_lock:
+        if _analysis_pool is None or (pool is not None and pool is not _analysis_pool):
+            return
+        retired, _analysis_pool = _analysis_pool, None
+    processes = list((retired._processes or {}).values()) if terminate else []
+    retired.shutdown(wait=False, cancel_futures=cancel)
+    for process in processes:
+        process.terminate()
+
+# kind -> (result field, analysis function, fallback result)
+ANALYZERS = {"skin": ("skin_tone", detect_skin_tone, "Unknown"),
+             "color": ("color", dominant_color, "Uncertain")}
+
+def analyze_file(fn, path):
+    # Pool side of a path entry: the image is read where it is analysed
+    with open(path, "rb") as f:
+        return fn(f.read())
+
+def analyze_many(kind, sources, fn, fallback, on_result=None):
+    # sources are image bytes or paths of stored files; paths keep the bytes
+    # out of the request thread and the pool's pickled call queue.
+    # Returns [(result, error)] in input order. A corrupt or slow image only
+    # fails its own entry (result = fallback), never the whole batch.
+    # on_result(i, result, error) is called as each entry completes. The
+    # whole batch shares one ANALYSIS_TIMEOUT deadline.
+    results, digests, calls = [], [], []
+    for source in sources:
+        try:
+            digest = content_hash(source) if isinstance(source, bytes) else file_hash(source)
+            results.append((cache_lookup(kind, digest), None))
+        except OSError as e:
+            digest = None
+            results.append((fallback, str(e)))
+        digests.append(digest)
+        calls.append(partial(fn, source) if isinstance(source, bytes) else partial(analyze_file, fn, source))
+    misses = [i for i, (r, _) in enumerate(results) if r is None]
+    if on_result:
+        for i, (result, error) in enumerate(results):
+            if result is not None:
+                on_result(i, result, error)
+    pool = analysis_pool() if len(misses) > 1 else None
+    futures = [(i, pool.submit(calls[i])) for i in misses] if pool else [(i, None) for i in misses]
+    deadline = time.monotonic() + app.config['ANALYSIS_TIMEOUT']
+    timed_out = False
+    for i, future in futures:
+        try:
+            if future is None:
+                result = calls[i]()
+            else:
+                result = future.result(timeout=max(deadline - time.monotonic(), 0))
+            results[i] = (result, None)
+            cache_store(kind, digests[i], result)
+        except FuturesTimeout:
+            timed_out = True
+            results[i] = (fallback, "timed out")
+        except BrokenProcessPool as e:
+            _reset_analysis_pool(pool)
+            results[i] = (fallback, str(e))
+        except Exception as e:
+            results[i] = (fallback, str(e) or type(e).__name__)
+        if on_result:
+            on_result(i, *results[i])
+    if timed_out:
+        _reset_analysis_pool(pool, terminate=True)
+    return results
+
+# ──────────────────────────────
+# WARDROBE STORE
+# ──────────────────────────────
+# Wardrobes live server-side, keyed by a random id kept in the session cookie,
+# instead of growing the signed cookie with every garment. Backends are
+# pluggable through WARDROBE_BACKENDS / WARDROBE_BACKEND.
+ITEM_TYPES = ("tops", "bottoms")
+
+DB_SCHEMA += """
+CREATE TABLE IF NOT EXISTS wardrobe_items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sid TEXT NOT NULL,
+    item_type TEXT NOT NULL,
+    color TEXT NOT NULL,
+    path TEXT NOT NULL,
+    created REAL NOT NULL,
+    added_version INTEGER NOT NULL DEFAULT 0,
+    removed_version INTEGER
+);
+CREATE INDEX IF NOT EXISTS wardrobe_items_by_color ON wardrobe_items (sid, item_type, color);
+CREATE TABLE IF NOT EXISTS wardrobes (
+    sid TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+"""
+DB_MIGRATIONS.append(("wardrobe_items", "added_version", "INTEGER NOT NULL DEFAULT 0"))
+DB_MIGRATIONS.append(("wardrobe_items", "removed_version", "INTEGER"))
+
+# Every change bumps the wardrobe's version; removals are soft so that
+# changes_since() can tell caches exactly what was added and removed.
+class WardrobeStore(ABC):
+    @abstractmethod
+    def add_items(self, sid, item_type, items):
+        # items: [{"path": ..., "color": ...}] in upload order; returns their ids
+        ...
+
+    @abstractmethod
+    def remove_item(self, sid, item_id):
+        # Returns False when the item does not exist (or is already removed)
+        ...
+
+    @abstractmethod
+    def version(self, sid):
+        ...
+
+    @abstractmethod
+    def changes_since(self, sid, version):
+        # ([(id, item_type, color, path), ...] added, [id, ...] removed) after
+        # `version`; removed ids may include items added after it too
+        ...
+
+    @abstractmethod
+    def referenced(self, paths, sid=None):
+        # The subset of `paths` that live items (of `sid`, or of anyone) point at
+        ...
+
+class SQLiteWardrobeStore(WardrobeStore):
+    def _bump(self, db, sid):
+        db.execute("INSERT INTO wardrobes VALUES (?, 1) ON CONFLICT (sid) DO UPDATE SET version = version + 1", (sid,))
+        return db.execute("SELECT version FROM wardrobes WHERE sid = ?", (sid,)).fetchone()[0]
+
+    def add_items(self, sid, item_type, items):
+        now = time.time()
+        db = get_db()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            version = self._bump(db, sid)
+            return [db.execute("INSERT INTO wardrobe_items (sid, item_type, color, path, created, added_version) "
+                               "VALUES (?, ?, ?, ?, ?, ?)",
+                               (sid, item_type, i["color"], i["path"], now, version)).lastrowid for i in items]
+
+    def remove_item(self, sid, item_id):
+        db = get_db()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            exists = db.execute("SELECT 1 FROM wardrobe_items WHERE id = ? AND sid = ? AND removed_version IS NULL",
+                                (item_id, sid)).fetchone()
+            if exists:
+                db.execute("UPDATE wardrobe_items SET removed_version = ? WHERE id = ?", (self._bump(db, sid), item_id))
+        return exists is not None
+
+    def version(self, sid):
+        row = get_db().execute("SELECT version FROM wardrobes WHERE sid = ?", (sid,)).fetchone()
+        return row[0] if row else 0
+
+    def changes_since(self, sid, version):
+        db = get_db()
+        added = db.execute("SELECT id, item_type, color, path FROM wardrobe_items WHERE sid = ? AND added_version > ? "
+                           "AND removed_version IS NULL ORDER BY id", (sid, version)).fetchall()
+        removed = [r[0] for r in db.execute("SELECT id FROM wardrobe_items WHERE sid = ? AND removed_version > ?",
+                                            (sid, version))]
+        return added, removed
+
+    def referenced(self, paths, sid=None):
+        found = set()
+        db = get_db()
+        for i in range(0, len(paths), 500):
+            chunk = list(paths[i:i + 500])
+            query = ("SELECT DISTINCT path FROM wardrobe_items WHERE removed_version IS NULL "
+                     f"AND path IN ({','.join('?' * len(chunk))})")
+            if sid is not None:
+                query += " AND sid = ?"
+                chunk.append(sid)
+            found.update(row[0] for row in db.execute(query, chunk))
+        return found
+
+class MemoryWardrobeStore(WardrobeStore):
+    # Single-process only (tests, `python app.py`)
+    def __init__(self):
+        self._items = {}                      # id -> [sid, item_type, color, path, added, removed]
+        self._versions = defaultdict(int)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def add_items(self, sid, item_type, items):
+        with self._lock:
+            self._versions[sid] += 1
+            ids = []
+            for i in items:
+                ids.append(next(self._ids))
+                self._items[ids[-1]] = [sid, item_type, i["color"], i["path"], self._versions[sid], None]
+            return ids
+
+    def remove_item(self, sid, item_id):
+        with self._lock:
+            item = self._items.get(item_id)
+            if item is None or item[0] != sid or item[5] is not None:
+                return False
+            self._versions[sid] += 1
+            item[5] = self._versions[sid]
+            return True
+
+    def version(self, sid):
+        with self._lock:
+            return self._versions.get(sid, 0)
+
+    def changes_since(self, sid, version):
+        with self._lock:
+            added = [(i, it[1], it[2], it[3]) for i, it in self._items.items()
+                     if it[0] == sid and it[5] is None and it[4] > version]
+            removed = [i for i, it in self._items.items()
+                       if it[0] == sid and it[5] is not None and it[5] > version]
+            return added, removed
+
+    def referenced(self, paths, sid=None):
+        with self._lock:
+            live = {it[3] for it in self._items.values() if it[5] is None and sid in (None, it[0])}
+            return live.intersection(paths)
+
+WARDROBE_BACKENDS = {"sqlite": SQLiteWardrobeStore, "memory": MemoryWardrobeStore}
+wardrobe = WARDROBE_BACKENDS[os.environ.get("WARDROBE_BACKEND", "sqlite")]()
+
+def session_id():
+    sid = session.get('sid')
+    if sid is None:
+        sid = session['sid'] = uuid.uuid4().hex
+    # Cookies from before the server-side store still carry their items
+    for item_type in ITEM_TYPES:
+        legacy = session.pop(item_type, None)
+        if legacy:
+            wardrobe.add_items(sid, item_type, legacy)
+    return sid
+
+# ──────────────────────────────
+# PAIRING ENGINE
+# ──────────────────────────────
+# Compact form of one user's wardrobe: per item type, parallel NumPy columns
+# of item id, interned color code and storage key. Which pairings exist and in
+# what order is worked out on whole arrays; dicts, URLs and reason text are
+# only built for the pairings a request actually returns. Order is preferred
+# top colors (all tops when none suit the skin tone) by bottom colors, both in
+# order of first upload; ranked layouts cover every color group by pair_score().
+COLOR_LABELS = []   # color code -> color name
+COLOR_CODES = {}    # color name -> color code
+_color_lock = threading.Lock()
+PAIRING_CHUNK = 1024   # pairings decoded per vectorized step
+
+def color_codes(names):
+    with _color_lock:
+        for name in names:
+            if name not in COLOR_CODES:
+                COLOR_CODES[name] = len(COLOR_LABELS)
+                COLOR_LABELS.append(name)
+        return np.array([COLOR_CODES[name] for name in names], np.int32)
+
+class ItemGroups:
+    # Items of one type grouped by color: groups in order of first upload,
+    # items within a group in upload order
+    def __init__(self, colors):
+        codes, first, inverse, sizes = np.unique(colors, return_index=True, return_inverse=True,
+                                                 return_counts=True)
+        rank = np.argsort(first, kind="stable")
+        group_of_code = np.empty(len(codes), np.int64)
+        group_of_code[rank] = np.arange(len(codes))
+        self.order = np.argsort(group_of_code[inverse], kind="stable")   # item indices
+        self.codes = codes[rank]
+        self.sizes = sizes[rank]
+        self.starts = np.cumsum(self.sizes) - self.sizes
+
+class PairingLayout:
+    # Output order as a list of (top group, bottom group) blocks; pairing i is
+    # found by a binary search over the block ends
+    def __init__(self, compact, skin_tone, ranked=False):
+        self.compact, self.skin_tone, self.ranked = compact, skin_tone, ranked
+        self.tops = ItemGroups(compact.colors["tops"])
+        self.bottoms = ItemGroups(compact.colors["bottoms"])
+        top_groups = np.arange(len(self.tops.codes))
+        bottom_groups = np.arange(len(self.bottoms.codes))
+        rules = RULES.get(skin_tone, [])
+        self.preferred = np.array([color_family(COLOR_LABELS[c]) in rules for c in self.tops.codes], bool)
+
+        if ranked:
+            scores = np.array([[pair_score(skin_tone, COLOR_LABELS[t], COLOR_LABELS[b]) for b in self.bottoms.codes]
+                               for t in self.tops.codes], np.float64).reshape(len(top_groups), len(bottom_groups))
+            order = np.argsort(-scores.ravel(), kind="stable")
+            self.block_top, self.block_bottom = np.divmod(order, len(bottom_groups))
+            self.block_score = scores.ravel()[order]
+        else:
+            if self.preferred.any():
+                top_groups = top_groups[self.preferred]
+            self.block_top = np.repeat(top_groups, len(bottom_groups))
+            self.block_bottom = np.tile(bottom_groups, len(top_groups))
+        sizes = self.tops.sizes[self.block_top] * self.bottoms.sizes[self.block_bottom]
+        self.block_ends = np.cumsum(sizes)
+        self.total = int(self.block_ends[-1]) if len(sizes) else 0
+        # Palette per (top group, bottom group), looked up on first use
+        self.palette_ids = np.full((len(self.tops.codes), len(self.bottoms.codes)), -1, np.int32)
+        self.palettes = []
+        self._palette_lock = threading.Lock()
+
+    def _palette(self, g, h):
+        pid = self.palette_ids[g, h]
+        if pid < 0:
+            with timed("palette_lookup"):
+                palette = find_best_sanzo_palette(COLOR_LABELS[self.tops.codes[g]], COLOR_LABELS[self.bottoms.codes[h]])
+            # Layouts are shared between request threads; an id is only
+            # published once its palette is in the list
+            with self._palette_lock:
+                pid = self.palette_ids[g, h]
+                if pid < 0:
+                    self.palettes.append(palette)
+                    pid = self.palette_ids[g, h] = len(self.palettes) - 1
+        return self.palettes[pid]
+
+    def locate(self, idx):
+        # Pairing positions -> (block, top item index, bottom item index) arrays
+        block = np.searchsorted(self.block_ends, idx, side="right")
+        g, h = self.block_top[block], self.block_bottom[block]
+        bottom_sizes = self.bottoms.sizes[h]
+        within = idx - (self.block_ends[block] - self.tops.sizes[g] * bottom_sizes)
+        top = self.tops.order[self.tops.starts[g] + within // bottom_sizes]
+        bottom = self.bottoms.order[self.bottoms.starts[h] + within % bottom_sizes]
+        return block, top, bottom
+
+    def _reason(self, block, face_note):
+        g, h = int(self.block_top[block]), int(self.block_bottom[block])
+        top = COLOR_LABELS[self.tops.codes[g]]
+        _, sanzo_note = self._palette(g, h)
+        if not self.ranked or self.preferred[g]:
+            return f"{top} suits {self.skin_tone} skin • {face_note} • {sanzo_note}"
+        bottom = COLOR_LABELS[self.bottoms.codes[h]]
+        return f"{top} complements {bottom} • {face_note} • {sanzo_note}"
+
+    def pairings(self, start, stop, face_shape):
+        stop = min(stop, self.total)
+        face_note = FACE_SHAPE_RULES.get(face_shape)
+        reasons = {}
+        for chunk in range(start, stop, PAIRING_CHUNK):
+            blocks, tops, bottoms = self.locate(np.arange(chunk, min(chunk + PAIRING_CHUNK, stop)))
+            for block, t, b in zip(blocks.tolist(), tops.tolist(), bottoms.tolist()):
+                g, h = int(self.block_top[block]), int(self.block_bottom[block])
+                reason = reasons.get(block)
+                if reason is None:
+                    reason = reasons[block] = self._reason(block, face_note)
+                pairing = {
+                    "top_color": COLOR_LABELS[self.tops.codes[g]],
+                    "top_img": self.compact.url("tops", t),
+                    "bottom_color": COLOR_LABELS[self.bottoms.codes[h]],
+                    "bottom_img": self.compact.url("bottoms", b),
+                    "reason": reason,
+                    "palette_colors": self._palette(g, h)[0],
+                }
+                if self.ranked:
+                    pairing["score"] = float(self.block_score[block])
+                yield pairing
+
+    def tables(self, start, stop, face_shape):
+        # The same pairings as rows of indices into shared tables:
+        # {"colors", "images", "reasons", "palettes", "pairings"[, "scores"]}
+        stop = max(min(stop, self.total), start)
+        face_note = FACE_SHAPE_RULES.get(face_shape)
+        blocks, tops, bottoms = self.locate(np.arange(start, stop))
+        used, block_of = np.unique(blocks, return_inverse=True)
+
+        def index(values):
+            # Deduplicated table plus each value's position in it
+            table, positions = {}, []
+            for value in values:
+                positions.append(table.setdefault(value, len(table)))
+            return list(table), np.array(positions, np.int64)
+
+        top_codes = self.tops.codes[self.block_top[used]]
+        bottom_codes = self.bottoms.codes[self.block_bottom[used]]
+        colors, color_idx = index(COLOR_LABELS[c] for c in np.concatenate([top_codes, bottom_codes]).tolist())
+        reasons, reason_idx = index(self._reason(b, face_note) for b in used.tolist())
+        palettes, palette_idx = index(tuple(self._palette(g, h)[0]) for g, h in
+                                      zip(self.block_top[used].tolist(), self.block_bottom[used].tolist()))
+        top_items, top_of = np.unique(tops, return_inverse=True)
+        bottom_items, bottom_of = np.unique(bottoms, return_inverse=True)
+        images, image_idx = index([self.compact.url("tops", t) for t in top_items.tolist()]
+                                  + [self.compact.url("bottoms", b) for b in bottom_items.tolist()])
+        rows = np.column_stack([
+            color_idx[:len(used)][block_of],
+            image_idx[:len(top_items)][top_of],
+            color_idx[len(used):][block_of],
+            image_idx[len(top_items):][bottom_of],
+            reason_idx[block_of],
+            palette_idx[block_of],
+        ]) if len(blocks) else np.zeros((0, 6), np.int64)
+        out = {"colors": colors, "images": images, "reasons": reasons,
+               "palettes": [list(p) for p in palettes], "pairings": rows}
+        if self.ranked:
+            out["scores"] = self.block_score[blocks]
+        return out
+
+class CompactWardrobe:
+    # Immutable once built; apply() returns an updated copy
+    def __init__(self, ids=None, colors=None, keys=None, urls=None):
+        self.ids = ids or {t: np.zeros(0, np.int64) for t in ITEM_TYPES}
+        self.colors = colors or {t: np.zeros(0, np.int32) for t in ITEM_TYPES}
+        self.keys = keys or {t: np.zeros(0, object) for t in ITEM_TYPES}
+        self._urls = urls if urls is not None else {}
+        self._layouts = {}
+
+    def apply(self, added, removed):
+        # added: [(id, item_type, color, path)] in id order; removed: [id]
+        ids, colors, keys = {}, {}, {}
+        removed = np.array(removed, np.int64)
+        for t in ITEM_TYPES:
+            keep = ~np.isin(self.ids[t], removed)
+            new = [a for a in added if a[1] == t]
+            new_ids = np.array([a[0] for a in new], np.int64)
+            fresh = ~np.isin(new_ids, self.ids[t])
+            new = [a for a, f in zip(new, fresh) if f]
+            ids[t] = np.concatenate([self.ids[t][keep], new_ids[fresh]])
+            colors[t] = np.concatenate([self.colors[t][keep], color_codes([a[2] for a in new])])
+            keys[t] = np.concatenate([self.keys[t][keep], np.array([os.path.basename(a[3]) for a in new], object)])
+        live = set(keys["tops"]) | set(keys["bottoms"])
+        urls = {key: url for key, url in self._urls.items() if key in live}
+        return CompactWardrobe(ids, colors, keys, urls)
+
+    def url(self, item_type, index):
+        key = self.keys[item_type][index]
+        url = self._urls.get(key)
+        if url is None:
+            url = self._urls[key] = url_for('uploaded_file', filename=key, size=THUMB_DEFAULT)
+        return url
+
+    def layout(self, skin_tone, ranked=False):
+        layout = self._layouts.get((skin_tone, ranked))
+        if layout is None:
+            layout = self._layouts[skin_tone, ranked] = PairingLayout(self, skin_tone, ranked)
+        return layout
+
+# Each worker keeps every user's compact wardrobe, keyed by wardrobe version
+# and the Sanzo data it was laid out against. When only the version moved,
+# changes_since() is replayed onto it: adds append to the columns, removals
+# drop rows, and nothing is computed per pairing until a page is requested.
+PAIRING_CACHE_SIZE = int(os.environ.get("PAIRING_CACHE_SIZE", "256"))   # users per worker
+_pairing_cache = OrderedDict()
+_pairing_lock = threading.Lock()
+
+def cached_wardrobe(sid):
+    version = wardrobe.version(sid)
+    key = (SANZO_VERSION, app.config['COLOR_MATCHING'])
+    with _pairing_lock:
+        state = _pairing_cache.get(sid)
+        if state is not None:
+            _pairing_cache.move_to_end(sid)
+    if state is not None and state["key"] == key:
+        if state["version"] == version:
+            inc("chameleon_pairing_cache_total", result="hit")
+            return state["compact"]
+        result = "incremental"
+    else:
+        # -1 so rows from before wardrobe versions (added_version 0) are included
+        result, state = "miss", {"key": key, "version": -1, "compact": CompactWardrobe()}
+    inc("chameleon_pairing_cache_total", result=result)
+
+    # Changes newer than `version` may be folded in already (a write can land
+    # between reading the version and the changes). Replaying them later is
+    # safe: apply() skips ids it already holds, and removals after a version
+    # include items added after it, so an item folded in early still goes.
+    compact = state["compact"].apply(*wardrobe.changes_since(sid, state["version"]))
+    with _pairing_lock:
+        _pairing_cache[sid] = {"key": key, "version": version, "compact": compact}
+        _pairing_cache.move_to_end(sid)
+        while len(_pairing_cache) > PAIRING_CACHE_SIZE:
+            _pairing_cache.popitem(last=False)
+    return compact
+
+# ──────────────────────────────
+# UPLOAD STORE
+# ──────────────────────────────
+# Each distinct upload is stored once under a key made of its SHA-256 and
+# extension, two hash-prefixed directory levels deep
+# (uploads/3f/a2/3fa2....jpg), so names never collide and a key's content
+# never changes. Every user who uploads a file owns it for quota purposes.
+# Over quota, the least recently used files that no live wardrobe item
+# references are evicted: for the per-user quota only that user's ownership
+# is dropped, and a file goes once nobody owns it. A background sweep also
+# removes unreferenced files idle for longer than UPLOAD_RETENTION, a small
+# batch per transaction; one worker claims it every UPLOAD_SWEEP_INTERVAL
+# seconds, and 0 leaves it to `flask --app app sweep-uploads` (e.g. from
+# cron). Files younger than UPLOAD_GRACE are never evicted (pending jobs,
+# face previews).
+app.config['UPLOAD_USER_QUOTA'] = int(os.environ.get("UPLOAD_USER_QUOTA", 512 * 1024 * 1024))
+app.config['UPLOAD_TOTAL_QUOTA'] = int(os.environ.get("UPLOAD_TOTAL_QUOTA", 20 * 1024 * 1024 * 1024))
+app.config['UPLOAD_RETENTION'] = int(os.environ.get("UPLOAD_RETENTION", 30 * 24 * 3600))
+UPLOAD_GRACE = 3600
+UPLOAD_TOUCH_INTERVAL = 3600   # last_access is refreshed at most this often
+UPLOAD_SWEEP_INTERVAL = int(os.environ.get("UPLOAD_SWEEP_INTERVAL", 600))
+UPLOAD_SWEEP_BATCH = 256
+UPLOAD_KEY_RE = re.compile(r"[0-9a-f]{32}(\.[a-z]+)?")
+UPLOAD_CHUNK = 1024 * 1024
+
+DB_SCHEMA += """
+CREATE TABLE IF NOT EXISTS uploads (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS uploads_by_access ON uploads (last_access);
+CREATE TABLE IF NOT EXISTS upload_owners (
+    sid TEXT NOT NULL,
+    key TEXT NOT NULL,
+    PRIMARY KEY (sid, key)
+);
+CREATE INDEX IF NOT EXISTS upload_owners_by_key ON upload_owners (key);
+CREATE INDEX IF NOT EXISTS wardrobe_items_by_path ON wardrobe_items (path);
+CREATE TABLE IF NOT EXISTS upload_sweeps (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    last REAL NOT NULL
+);
+INSERT OR IGNORE INTO upload_sweeps VALUES (1, 0);
+"""
+
+class StorageQuotaExceeded(Exception):
+    pass
+
+def upload_key(digest, filename):
+    ext = os.path.splitext(secure_filename(filename or ""))[1].lower()
+    return digest[:32] + (ext if ext in IMAGE_EXTENSIONS else "")
+
+class UploadStore:
+    def __init__(self, root):
+        self.root = root
+        self.incoming = os.path.join(root, ".incoming")   # partial files, same filesystem
+        os.makedirs(self.incoming, exist_ok=True)
+        self._sweeper_pid = None
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def thumb_path(self, key, size, ext):
+        return os.path.join(self.root, ".thumbs", str(size), key[:2], key + ext)
+
+    def put(self, sid, data, filename, digest=None):
+        # Stores bytes for `sid`; returns the stored path
+        key = upload_key(digest or content_hash(data), filename)
+        self._admit(sid, key, len(data))
+        path = self.path(key)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            write_file(tmp, data)
+            os.replace(tmp, path)
+        return path
+
+    def put_file(self, sid, src, filename):
+        # Moves a file written elsewhere under self.root into the store
+        digest, size = hashlib.sha256(), 0
+        with open(src, "rb") as f:
+            for chunk in iter(lambda: f.read(UPLOAD_CHUNK), b""):
+                digest.update(chunk)
+                size += len(chunk)
+        key = upload_key(digest.hexdigest(), filename)
+        try:
+            self._admit(sid, key, size)
+        except StorageQuotaExceeded:
+            os.remove(src)
+            raise
+        path = self.path(key)
+        if os.path.exists(path):
+            os.remove(src)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(src, path)
+        return path
+
+    def resolve(self, key):
+        # Path of a stored key, or None for anything else (legacy flat files)
+        if not UPLOAD_KEY_RE.fullmatch(key):
+            return None
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return None
+        now = time.time()
+        db = get_db()
+        row = db.execute("SELECT last_access FROM uploads WHERE key = ?", (key,)).fetchone()
+        if row and now - row[0] > UPLOAD_TOUCH_INTERVAL:
+            db.execute("UPDATE uploads SET last_access = ? WHERE key = ?", (now, key))
+        return path
+
+    def usage(self, sid=None):
+        db = get_db()
+        if sid is None:
+            return db.execute("SELECT COALESCE(SUM(size), 0) FROM uploads").fetchone()[0]
+        return db.execute("SELECT COALESCE(SUM(size), 0) FROM upload_owners JOIN uploads USING (key) "
+                          "WHERE sid = ?", (sid,)).fetchone()[0]
+
+    def _admit(self, sid, key, size):
+        # Records sid as an owner of key, evicting what it takes to stay
+        # within both quotas
+        self._ensure_sweeper()
+        now = time.time()
+        db = get_db()
+        gone = []
+        with db:   # an exception rolls back the evictions too
+            db.execute("BEGIN IMMEDIATE")
+            stored = db.execute("SELECT 1 FROM uploads WHERE key = ?", (key,)).fetchone() is not None
+            owned = stored and db.execute("SELECT 1 FROM upload_owners WHERE sid = ? AND key = ?",
+                                          (sid, key)).fetchone() is not None
+            over = self.usage(sid) + (0 if owned else size) - app.config['UPLOAD_USER_QUOTA']
+            if over > 0:
+                freed, gone = self._evict(db, over, now - UPLOAD_GRACE, sid=sid, keep=key)
+                if freed < over:
+                    raise StorageQuotaExceeded("upload quota exceeded for this user")
+            over = self.usage() + (0 if stored else size) - app.config['UPLOAD_TOTAL_QUOTA']
+            if over > 0:
+                freed, more = self._evict(db, over, now - UPLOAD_GRACE, keep=key)
+                gone += more
+                if freed < over:
+                    raise StorageQuotaExceeded("upload storage is full")
+            db.execute("INSERT INTO uploads VALUES (?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET last_access = ?",
+                       (key, size, now, now, now))
+            db.execute("INSERT OR IGNORE INTO upload_owners VALUES (?, ?)", (sid, key))
+        self._unlink(gone)
+
+    def _evict(self, db, need, before, sid=None, keep=None):
+        # Least recently used, unreferenced files first; returns (bytes freed,
+        # keys whose files should be deleted once the transaction commits)
+        if sid is None:
+            query, args = "SELECT key, size FROM uploads WHERE created < ?", [before]
+        else:
+            query, args = "SELECT key, size FROM upload_owners JOIN uploads USING (key) WHERE sid = ? AND created < ?", [sid, before]
+        rows = [r for r in db.execute(query + " ORDER BY last_access", args) if r[0] != keep]
+        freed, gone = 0, []
+        for i in range(0, len(rows), 256):
+            if need is not None and freed >= need:
+                break
+            batch = rows[i:i + 256]
+            referenced = wardrobe.referenced([self.path(k) for k, _ in batch], sid)
+            for key, size in batch:
+                if self.path(key) in referenced:
+                    continue
+                if sid is not None:
+                    db.execute("DELETE FROM upload_owners WHERE sid = ? AND key = ?", (sid, key))
+                    if db.execute("SELECT 1 FROM upload_owners WHERE key = ?", (key,)).fetchone() is None \
+                            and not wardrobe.referenced([self.path(key)]):
+                        db.execute("DELETE FROM uploads WHERE key = ?", (key,))
+                        gone.append(key)
+                else:
+                    db.execute("DELETE FROM upload_owners WHERE key = ?", (key,))
+                    db.execute("DELETE FROM uploads WHERE key = ?", (key,))
+                    gone.append(key)
+                freed += size
+                if need is not None and freed >= need:
+                    break
+        return freed, gone
+
+    def _unlink(self, keys):
+        for key in keys:
+            paths = [self.path(key)] + [self.thumb_path(key, size, ext) for size in THUMB_SIZES
+                                        for ext in (".webp", ".jpg")]
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        if keys:
+            inc("chameleon_uploads_evicted_total", len(keys))
+
+    def sweep(self):
+        # Age-based eviction; returns (files removed, bytes freed). Each batch
+        # commits on its own so uploads in other workers only ever wait for
+        # one batch.
+        now = time.time()
+        before, idle_before = now - UPLOAD_GRACE, now - app.config['UPLOAD_RETENTION']
+        db = get_db()
+        removed = freed = 0
+        after = (0, "")
+        while True:
+            gone = []
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                rows = db.execute("SELECT key, size, last_access FROM uploads WHERE created < ? AND last_access < ? "
+                                  "AND (last_access, key) > (?, ?) ORDER BY last_access, key LIMIT ?",
+                                  (before, idle_before, *after, UPLOAD_SWEEP_BATCH)).fetchall()
+                if rows:
+                    after = rows[-1][2], rows[-1][0]
+                    referenced = wardrobe.referenced([self.path(k) for k, _, _ in rows])
+                    for key, size, _ in rows:
+                        if self.path(key) not in referenced:
+                            db.execute("DELETE FROM upload_owners WHERE key = ?", (key,))
+                            db.execute("DELETE FROM uploads WHERE key = ?", (key,))
+                            gone.append(key)
+                            freed += size
+            self._unlink(gone)
+            removed += len(gone)
+            if len(rows) < UPLOAD_SWEEP_BATCH:
+                return removed, freed
+
+    def _ensure_sweeper(self):
+        # Started by the first upload in each process, so a preloading
+        # gunicorn master never runs one
+        if UPLOAD_SWEEP_INTERVAL > 0 and self._sweeper_pid != os.getpid():
+            self._sweeper_pid = os.getpid()
+            threading.Thread(target=self._sweep_forever, name="upload-sweep", daemon=True).start()
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(UPLOAD_SWEEP_INTERVAL)
+            try:
+                now = time.time()
+                # Whichever worker claims the slot first sweeps for everyone
+                claimed = get_db().execute("UPDATE upload_sweeps SET last = ? WHERE last < ?",
+                                           (now, now - UPLOAD_SWEEP_INTERVAL)).rowcount
+                if claimed:
+                    self.sweep()
+            except Exception as e:
+                print(f"Upload sweep failed: {e}")
+
+uploads = UploadStore(app.config['UPLOAD_FOLDER'])
+
+@app.cli.command("sweep-uploads")
+def sweep_uploads():
+    """Delete unreferenced uploads that have been idle longer than UPLOAD_RETENTION."""
+    with app.app_context():
+        removed, freed = uploads.sweep()
+    print(f"Removed {removed} files ({freed} bytes); {uploads.usage()} bytes stored")
+
+# ──────────────────────────────
+# BACKGROUND JOBS
+# ──────────────────────────────
+# With async=1 the upload endpoints store the files, create a job row and
+# return 202 with its id; the analysis then runs on a per-worker thread pool
+# (which in turn feeds the analysis pool). Job state lives in SQLite so any
+# worker can answer /api/jobs/<id>. Garments go straight into the wardrobe
+# store when their job finishes; a face job's skin tone is folded into the
+# caller's session by collect_jobs(). Jobs carry the stored paths, not the
+# image bytes. While a worker holds a job (queued or running) it refreshes
+# the job's `updated` every JOB_HEARTBEAT seconds; a job not refreshed for
+# JOB_STALE seconds belonged to a worker that died or was recycled and is
+# reported as failed.
+app.config['ASYNC_UPLOADS'] = os.environ.get("ASYNC_UPLOADS") == "1"
+app.config['JOB_THREADS'] = int(os.environ.get("JOB_THREADS", 2))
+JOB_TTL = 24 * 3600
+JOB_HEARTBEAT = 10
+JOB_STALE = 60
+
+DB_SCHEMA += """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    item_type TEXT,
+    status TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    items TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+_job_pool = None
+_job_pool_pid = None
+_held_jobs = set()   # ids this process has queued or is running
+
+def job_pool():
+    global _job_pool, _job_pool_pid
+    if _job_pool is None or _job_pool_pid != os.getpid():
+        _job_pool = ThreadPoolExecutor(max_workers=app.config['JOB_THREADS'], thread_name_prefix="analysis-job")
+        _job_pool_pid = os.getpid()
+        _held_jobs.clear()
+        threading.Thread(target=_heartbeat_jobs_forever, name="job-heartbeat", daemon=True).start()
+    return _job_pool
+
+def _heartbeat_jobs_forever():
+    while True:
+        time.sleep(JOB_HEARTBEAT)
+        held = list(_held_jobs)
+        if not held:
+            continue
+        try:
+            get_db().execute(f"UPDATE jobs SET updated = ? WHERE id IN ({','.join('?' * len(held))})",
+                             (time.time(), *held))
+        except sqlite3.Error as e:
+            print(f"Job heartbeat failed: {e}")
+
+def wants_async():
+    flag = request.values.get('async')
+    return app.config['ASYNC_UPLOADS'] if flag is None else flag == "1"
+
+def create_job(kind, item_type, paths):
+    job_id = uuid.uuid4().hex
+    items = [{"file": os.path.basename(p), "path": p} for p in paths]
+    now = time.time()
+    db = get_db()
+    db.execute("DELETE FROM jobs WHERE updated < ?", (now - JOB_TTL,))
+    db.execute("INSERT INTO jobs VALUES (?, ?, ?, 'pending', ?, 0, ?, ?, ?)",
+               (job_id, kind, item_type, len(items), json.dumps(items), now, now))
+    return job_id
+
+def get_job(job_id):
+    db = get_db()
+    row = db.execute("SELECT id, kind, item_type, status, total, done, items, updated FROM jobs WHERE id = ?",
+                     (job_id,)).fetchone()
+    if row is None:
+        return None
+    keys = ("id", "kind", "item_type", "status", "total", "done", "items")
+    job = dict(zip(keys, row))
+    job["items"] = json.loads(job["items"])
+    stale = time.time() - JOB_STALE
+    if job["status"] in ("pending", "running") and row[-1] < stale:
+        db.execute("UPDATE jobs SET status = 'failed' WHERE id = ? AND status IN ('pending', 'running') "
+                   "AND updated < ?", (job_id, stale))
+        job["status"] = "failed"
+    return job
+
+def _update_job(job_id, status, done, items):
+    get_db().execute("UPDATE jobs SET status = ?, done = ?, items = ?, updated = ? WHERE id = ?",
+                     (status, done, json.dumps(items), time.time(), job_id))
+
+def run_job(job_id, kind, paths, sid=None, item_type=None):
+    items = [{"file": os.path.basename(p), "path": p} for p in paths]
+    done = 0
+    field, fn, fallback = ANALYZERS[kind]
+
+    def on_result(i, result, error):
+        nonlocal done
+        items[i][field] = result
+        if error:
+            items[i]["error"] = error
+        done += 1
+        _update_job(job_id, "running", done, items)
+
+    status = "done"
+    try:
+        _update_job(job_id, "running", 0, items)
+        analyze_many(kind, paths, fn, fallback, on_result)
+    except Exception as e:
+        print(f"Job {job_id} failed: {e}")
+        status = "failed"
+    try:
+        if kind == "color":
+            wardrobe.add_items(sid, item_type, [{"path": i["path"], "color": i.get("color", fallback)} for i in items])
+        _update_job(job_id, status, done, items)
+    finally:
+        _held_jobs.discard(job_id)
+
+def submit_job(kind, item_type, paths):
+    job_id = create_job(kind, item_type, paths)
+    pool = job_pool()
+    _held_jobs.add(job_id)
+    pool.submit(run_job, job_id, kind, paths, session_id(), item_type)
+    session['jobs'] = session.get('jobs', []) + [job_id]
+    return job_id
+
+def collect_jobs():
+    # Applies finished face jobs to the session; returns the ids still running
+    pending = []
+    for job_id in session.get('jobs', []):
+        job = get_job(job_id)
+        if job is None:
+            continue
+        if job["status"] not in ("done", "failed"):
+            pending.append(job_id)
+        elif job["kind"] == "skin":
+            session['skin_tone'] = job["items"][0].get("skin_tone", "Unknown")
+    if pending != session.get('jobs', []):
+        session['jobs'] = pending
+    return pending
 
 # ──────────────────────────────
 # API Endpoints
@@ -142,53 +1888,692 @@ def save_face_shape():
 
 @app.route('/api/upload_face', methods=['POST'])
 def upload_face():
-    file = request.files.get('file')
+    with timed("multipart_parse"):
+        file = request.files.get('file')
     if not file or file.filename == '':
         return jsonify({"error": "No file"}), 400
-    filename = secure_filename(file.filename)
-    path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(path)
-    skin_tone = detect_skin_tone(path)
+    data = file.read()
+    digest = content_hash(data)
+    saved = io_pool().submit(uploads.put, session_id(), data, file.filename, digest)
+    preview_url = url_for('uploaded_file', filename=upload_key(digest, file.filename), size=THUMB_DEFAULT)
+    if wants_async():
+        try:
+            path = saved.result()
+        except StorageQuotaExceeded as e:
+            return jsonify({"error": str(e)}), 413
+        job_id = submit_job("skin", None, [path])
+        return jsonify({"success": True, "job_id": job_id, "status": "pending", "preview_url": preview_url}), 202
+    skin_tone = cached_analysis("skin", data, detect_skin_tone, digest)
+    try:
+        saved.result()
+    except StorageQuotaExceeded as e:
+        return jsonify({"error": str(e)}), 413
     session['skin_tone'] = skin_tone
     return jsonify({
         "success": True,
         "skin_tone": skin_tone,
-        "preview_url": url_for('uploaded_file', filename=filename)
+        "preview_url": preview_url
+    })
+
+SKIN_FRAME_MAX_BYTES = 8 * 1024 * 1024
+
+def iter_multipart_files(stream, boundary, max_bytes):
+    # Yields the bytes of each file part as soon as it is complete (None for
+    # parts over max_bytes); stops reading the body when the caller stops
+    decoder = MultipartDecoder(boundary.encode(), max_form_memory_size=IMPORT_CHUNK * 4)
+    parts, size = None, 0
+    while True:
+        chunk = stream.read(IMPORT_CHUNK)
+        decoder.receive_data(chunk or None)
+        event = decoder.next_event()
+        while not isinstance(event, NeedData):
+            if isinstance(event, File):
+                parts, size = [], 0
+            elif isinstance(event, Field):
+                parts = None
+            elif isinstance(event, Data) and parts is not None:
+                size += len(event.data)
+                if size <= max_bytes:
+                    parts.append(event.data)
+                if not event.more_data:
+                    yield b"".join(parts) if size <= max_bytes else None
+                    parts = None
+            elif isinstance(event, Epilogue):
+                return
+            event = decoder.next_event()
+        if not chunk:
+            return
+
+@app.route('/api/skin_tone/frames', methods=['POST'])
+def skin_tone_frames():
+    # Camera frames as multipart file parts, in capture order, in one request
+    # or spread over several: the running estimate is kept in the session
+    # until ?reset=1. Frames after the estimate is stable are not read at all.
+    # ?face=1 masks only the detected face region.
+    boundary = request.mimetype_params.get("boundary")
+    if request.mimetype != "multipart/form-data" or not boundary:
+        return jsonify({"error": "send frames as multipart/form-data"}), 400
+    face = request.args.get('face') == '1'
+    state = None if request.args.get('reset') == '1' else session.get('skin_stream')
+    estimate = SkinToneEstimate(*state) if state else SkinToneEstimate()
+    used = skipped = faces = 0
+    frames = iter_multipart_files(request.stream, boundary, SKIN_FRAME_MAX_BYTES)
+    while not estimate.done():
+        data = next(frames, False)
+        if data is False:
+            break
+        img = load_image(data, (200, 200)) if data else None
+        inc("chameleon_images_processed_total", kind="skin_frame")
+        sample = skin_brightness(img, face) if img is not None else None
+        if sample is None:
+            skipped += 1
+            continue
+        brightness, _, region = sample
+        estimate.add(brightness)
+        used += 1
+        faces += region is not None
+    inc("chameleon_skin_frames_total", used, result="used")
+    inc("chameleon_skin_frames_total", skipped, result="skipped")
+
+    session['skin_stream'] = estimate.state()
+    if estimate.n:
+        session['skin_tone'] = estimate.tone()
+    h = estimate.half_width()
+    return jsonify({
+        "skin_tone": estimate.tone(),
+        "stable": estimate.stable(),
+        "done": estimate.done(),
+        "brightness": round(estimate.mean, 2) if estimate.n else None,
+        "interval": [round(estimate.mean - h, 2), round(estimate.mean + h, 2)] if estimate.n > 1 else None,
+        "frames": estimate.n,
+        "used": used,
+        "skipped": skipped,
+        "faces": faces,
     })
 
 @app.route('/api/upload_clothes', methods=['POST'])
 def upload_clothes():
-    files = request.files.getlist('files')
+    with timed("multipart_parse"):
+        files = request.files.getlist('files')
     item_type = request.form.get('type')   # 'tops' or 'bottoms'
+    if item_type not in ITEM_TYPES:
+        return jsonify({"error": "type must be 'tops' or 'bottoms'"}), 400
 
-    uploaded = session.get(item_type, [])
+    saves, blobs = [], []
+    sid = session_id()
 
     for file in files:
         if file.filename:
-            filename = secure_filename(file.filename)
-            path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(path)
-            uploaded.append({"path": path, "color": dominant_color(path)})
-
-    session[item_type] = uploaded
-    return jsonify({"status": "ok", "count": len(files)})
-
+            data = file.read()
+            saves.append(io_pool().submit(uploads.put, sid, data, file.filename))
+            blobs.append(data)
+
+    def saved_paths():
+        return [saved.result() for saved in saves]
+
+    if wants_async():
+        try:
+            paths = saved_paths()
+        except StorageQuotaExceeded as e:
+            return jsonify({"error": str(e)}), 413
+        job_id = submit_job("color", item_type, paths)
+        return jsonify({"status": "accepted", "job_id": job_id, "count": len(files)}), 202
+
+    results = analyze_many("color", blobs, dominant_color, "Uncertain")
+    try:
+        paths = saved_paths()
+    except StorageQuotaExceeded as e:
+        return jsonify({"error": str(e)}), 413
+    uploaded, items = [], []
+    for path, (color, error) in zip(paths, results):
+        uploaded.append({"path": path, "color": color})
+        items.append({"file": os.path.basename(path), "color": color, **({"error": error} if error else {})})
+
+    for item, item_id in zip(items, wardrobe.add_items(sid, item_type, uploaded)):
+        item["id"] = item_id
+    return jsonify({"status": "ok", "count": len(files), "items": items})
+
+@app.route('/api/clothes/<int:item_id>', methods=['DELETE'])
+def delete_clothes(item_id):
+    # The file stays in the upload store until eviction finds it unreferenced
+    if not wardrobe.remove_item(session_id(), item_id):
+        return jsonify({"error": "Unknown item"}), 404
+    return jsonify({"status": "ok", "id": item_id})
+
+def _job_view(job):
+    items = [{k: v for k, v in i.items() if k != "path"} for i in job["items"]]
+    return {"job_id": job["id"], "status": job["status"], "total": job["total"], "done": job["done"], "items": items}
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    if job_id in session.get('jobs', []):
+        collect_jobs()
+    return jsonify(_job_view(job))
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    # Server-sent events: one "progress" event per change, then "done"
+    if get_job(job_id) is None:
+        return jsonify({"error": "Unknown job"}), 404
+
+    def stream():
+        last = None
+        deadline = time.monotonic() + 300
+        while time.monotonic() < deadline:
+            job = get_job(job_id)
+            state = (job["status"], job["done"])
+            if state != last:
+                last = state
+                finished = job["status"] in ("done", "failed")
+                yield f"event: {'done' if finished else 'progress'}\ndata: {json.dumps(_job_view(job))}\n\n"
+                if finished:
+                    return
+            time.sleep(0.2)
+
+    return Response(stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+# Compact /api/generate responses: encoded with orjson when it is installed
+# (NumPy index rows go out without a Python-level copy), gzipped for clients
+# that accept it.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Columns of each pairings row and the table each one indexes; ranked (?k=)
+# responses add a "scores" list parallel to the rows
+COMPACT_FIELDS = ["top_color", "top_img", "bottom_color", "bottom_img", "reason", "palette_colors"]
+COMPACT_GZIP_LEVEL = 5
+COMPACT_GZIP_MIN_BYTES = 1024
+
+def encode_json(obj):
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, separators=(",", ":"),
+                      default=lambda o: o.tolist() if isinstance(o, np.ndarray) else str(o)).encode()
+
+def send_compact(obj):
+    with timed("serialize"):
+        body = encode_json(obj)
+    response = Response(body, mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+    if len(body) >= COMPACT_GZIP_MIN_BYTES and request.accept_encodings["gzip"]:
+        with timed("compress"):
+            response.set_data(gzip.compress(body, compresslevel=COMPACT_GZIP_LEVEL))
+        response.headers["Content-Encoding"] = "gzip"
+    return response
 
 @app.route('/api/generate', methods=['GET'])
 def generate():
+    # A page of limit<1 would never advance next_offset
+    limit = request.args.get('limit', type=int)
+    k = request.args.get('k', type=int)
+    if limit is not None and limit < 1:
+        return jsonify({"error": "limit must be a positive integer"}), 400
+    if k is not None and k < 0:
+        return jsonify({"error": "k must not be negative"}), 400
+
+    # ?wait=<seconds> blocks until pending upload jobs finish (or time runs out)
+    wait = min(request.args.get('wait', 0, type=float), 60)
+    deadline = time.monotonic() + wait
+    pending = collect_jobs()
+    while pending and time.monotonic() < deadline:
+        time.sleep(0.1)
+        pending = collect_jobs()
+
     skin_tone = session.get('skin_tone', 'Unknown')
     face_shape = session.get('face_shape', 'Oval')
 
-    tops_dict = defaultdict(list)
-    bottoms_dict = defaultdict(list)
+    sid = session_id()
+
+    # ?offset=&limit= pages through the pairings; ?stream=1 (or Accept:
+    # application/x-ndjson) streams them one JSON object per line instead
+    # ?k=N returns only the N best-scoring pairings, best first (pages apply
+    # within those N)
+    # ?format=compact sends each palette, reason, color and image URL once and
+    # pairings as index rows into those tables (see COMPACT_FIELDS)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    layout = cached_wardrobe(sid).layout(skin_tone, ranked=k is not None)
+    total = layout.total if k is None else min(k, layout.total)
+    end = total if limit is None else min(offset + limit, total)
+
+    if request.args.get('format') == 'compact':
+        with timed("pairing"):
+            body = layout.tables(offset, end, face_shape)
+        inc("chameleon_pairings_emitted_total", len(body["pairings"]))
+        return send_compact({
+            "format": "compact",
+            "fields": COMPACT_FIELDS,
+            **body,
+            "skin_tone": skin_tone,
+            "pending": pending,
+            "total": total,
+            "next_offset": end if end < total else None,
+        })
+    pairings = counted_pairings(layout.pairings(offset, end, face_shape))
+
+    if request.args.get('stream') == '1' or request.accept_mimetypes.best == "application/x-ndjson":
+        lines = (json.dumps(p) + "\n" for p in pairings)
+        return Response(stream_with_context(lines), mimetype="application/x-ndjson", headers={
+            "X-Skin-Tone": skin_tone,
+            "X-Total-Count": str(total),
+            "X-Pending-Jobs": ",".join(pending),
+        })
+    return jsonify({
+        "pairings": list(pairings),
+        "skin_tone": skin_tone,
+        "pending": pending,
+        "total": total,
+        "next_offset": end if end < total else None,
+    })
 
-    for i in session.get('tops', []):
-        tops_dict[i['color']].append(i['path'])
-    for i in session.get('bottoms', []):
-        bottoms_dict[i['color']].append(i['path'])
+@app.route('/api/cache_stats', methods=['GET'])
+def cache_stats():
+    # Counters are per worker process
+    with _analysis_lock:
+        return jsonify({**ANALYSIS_CACHE_STATS, "entries": len(_analysis_lru), "pid": os.getpid()})
 
-    pairings = generate_all_pairings(skin_tone, face_shape, tops_dict, bottoms_dict)
-    return jsonify({"pairings": pairings, "skin_tone": skin_tone})
+# ──────────────────────────────
+# BULK IMPORT
+# ──────────────────────────────
+# POST /api/import_clothes?type=tops takes either a zip archive (as the raw
+# body) or a multipart/form-data stream of files. The body is consumed in
+# fixed-size chunks; every entry is written to a partial file as it arrives,
+# moved into the upload store once complete and analysed in small batches, so memory stays bounded no matter how
+# large the import is. Returns a manifest with one row per entry.
+app.config['IMPORT_MAX_FILE_BYTES'] = int(os.environ.get("IMPORT_MAX_FILE_BYTES", 25 * 1024 * 1024))
+app.config['IMPORT_MAX_TOTAL_BYTES'] = int(os.environ.get("IMPORT_MAX_TOTAL_BYTES", 1024 * 1024 * 1024))
+app.config['IMPORT_MAX_FILES'] = int(os.environ.get("IMPORT_MAX_FILES", 1000))
+IMPORT_CHUNK = 64 * 1024
+IMPORT_BATCH = 16
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff"}
+ZIP_TYPES = {"application/zip", "application/x-zip-compressed", "application/octet-stream"}
+
+class ImportQuotaExceeded(Exception):
+    pass
+
+class BulkImport:
+    def __init__(self, sid, item_type):
+        self.sid, self.item_type = sid, item_type
+        self.manifest, self.batch = [], []
+        self.total_bytes = 0
+        self.files = 0
+
+    def check_total(self, size):
+        self.total_bytes += size
+        if self.total_bytes > app.config['IMPORT_MAX_TOTAL_BYTES']:
+            raise ImportQuotaExceeded("total import size quota exceeded")
+
+    def accept(self, name):
+        # Returns the manifest row for a new entry, or None if it is skipped
+        row = {"name": name, "status": "skipped"}
+        self.manifest.append(row)
+        if os.path.splitext(name)[1].lower() not in IMAGE_EXTENSIONS:
+            row["error"] = "not an image"
+            return None
+        self.files += 1
+        if self.files > app.config['IMPORT_MAX_FILES']:
+            raise ImportQuotaExceeded("too many files")
+        filename = secure_filename(os.path.basename(name))
+        if not filename:
+            row["error"] = "invalid file name"
+            return None
+        row.update(file=filename, path=os.path.join(uploads.incoming, f"{uuid.uuid4().hex}.part"), size=0)
+        return row
+
+    def stored(self, row):
+        try:
+            row["path"] = uploads.put_file(self.sid, row["path"], row["file"])
+        except StorageQuotaExceeded as e:
+            row.update(status="skipped", error=str(e))
+            raise ImportQuotaExceeded(str(e))
+        row.update(status="stored", file=os.path.basename(row["path"]))
+        self.batch.append(row)
+        if len(self.batch) >= IMPORT_BATCH:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        # Stored paths, not bytes: each pool process reads its own image
+        results = analyze_many("color", [row["path"] for row in self.batch], dominant_color, "Uncertain")
+        for row, (color, error) in zip(self.batch, results):
+            row.update(status="ok", color=color)
+            if error:
+                row["error"] = error
+        wardrobe.add_items(self.sid, self.item_type, [{"path": r["path"], "color": r["color"]} for r in self.batch])
+        self.batch = []
+
+    def result(self):
+        return [{k: v for k, v in row.items() if k != "path"} for row in self.manifest]
+
+def _spool_body(stream, importer):
+    # Copies the request body to a temporary file, enforcing the total quota
+    spool = tempfile.TemporaryFile()
+    while True:
+        chunk = stream.read(IMPORT_CHUNK)
+        if not chunk:
+            break
+        importer.check_total(len(chunk))
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+def import_zip(stream, importer):
+    max_file = app.config['IMPORT_MAX_FILE_BYTES']
+    with _spool_body(stream, importer) as spool:
+        importer.total_bytes = 0   # from here on the quota counts uncompressed bytes
+        try:
+            archive = zipfile.ZipFile(spool)
+        except zipfile.BadZipFile:
+            raise ValueError("not a zip archive")
+        with archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                row = importer.accept(info.filename)
+                if row is None:
+                    continue
+                if info.file_size > max_file:
+                    row.update(status="skipped", error="file too large", size=info.file_size)
+                    continue
+                try:
+                    with archive.open(info) as src, open(row["path"], "wb") as dst:
+                        while True:
+                            chunk = src.read(IMPORT_CHUNK)
+                            if not chunk:
+                                break
+                            row["size"] += len(chunk)
+                            if row["size"] > max_file:
+                                break
+                            importer.check_total(len(chunk))
+                            dst.write(chunk)
+                except (ImportQuotaExceeded, zipfile.BadZipFile, OSError) as e:
+                    os.remove(row["path"])
+                    row.update(status="skipped", error=str(e))
+                    if isinstance(e, ImportQuotaExceeded):
+                        raise
+                    continue
+                if row["size"] > max_file:
+                    os.remove(row["path"])
+                    row.update(status="skipped", error="file too large")
+                    continue
+                importer.stored(row)
+
+def import_multipart(stream, boundary, importer):
+    max_file = app.config['IMPORT_MAX_FILE_BYTES']
+    decoder = MultipartDecoder(boundary.encode(), max_form_memory_size=IMPORT_CHUNK * 4)
+    row, out = None, None
+
+    def close_entry():
+        # The entry is detached first: stored() may raise after the upload
+        # store has already consumed (or removed) the partial file
+        nonlocal row, out
+        entry, partial_file = row, out
+        row, out = None, None
+        if partial_file is not None:
+            partial_file.close()
+            if entry["size"] > max_file:
+                os.remove(entry["path"])
+                entry.update(status="skipped", error="file too large")
+            else:
+                importer.stored(entry)
+
+    try:
+        finished = False
+        while not finished:
+            chunk = stream.read(IMPORT_CHUNK)
+            importer.check_total(len(chunk))
+            decoder.receive_data(chunk or None)
+            event = decoder.next_event()
+            while not isinstance(event, NeedData):
+                if isinstance(event, File):
+                    close_entry()
+                    row = importer.accept(event.filename or "")
+                    out = open(row["path"], "wb") if row else None
+                elif isinstance(event, Field):
+                    close_entry()
+                elif isinstance(event, Data) and out is not None:
+                    row["size"] += len(event.data)
+                    if row["size"] <= max_file:
+                        out.write(event.data)
+                elif isinstance(event, Epilogue):
+                    finished = True
+                    break
+                event = decoder.next_event()
+            if not chunk:
+                finished = True
+    except BaseException as e:
+        if out is not None:
+            out.close()
+            try:
+                os.remove(row["path"])
+            except FileNotFoundError:
+                pass
+            row.update(status="skipped", error=str(e) or "import aborted")
+        raise
+    close_entry()
+
+@app.route('/api/import_clothes', methods=['POST'])
+def import_clothes():
+    item_type = request.args.get('type')
+    if item_type not in ITEM_TYPES:
+        return jsonify({"error": "type must be 'tops' or 'bottoms'"}), 400
+    importer = BulkImport(session_id(), item_type)
+    status = 200
+    error = None
+    try:
+        if request.mimetype == "multipart/form-data":
+            boundary = request.mimetype_params.get("boundary")
+            if not boundary:
+                return jsonify({"error": "missing multipart boundary"}), 400
+            import_multipart(request.stream, boundary, importer)
+        elif request.mimetype in ZIP_TYPES:
+            import_zip(request.stream, importer)
+        else:
+            return jsonify({"error": "send a zip archive or multipart/form-data"}), 415
+    except ImportQuotaExceeded as e:
+        status, error = 413, str(e)
+    except RequestEntityTooLarge as e:
+        # Multipart headers over the decoder's memory limit
+        status, error = 413, e.description
+    except ValueError as e:
+        status, error = 400, str(e)
+    importer.flush()
+    body = {
+        "status": "ok" if error is None else "error",
+        "imported": sum(1 for r in importer.manifest if r["status"] == "ok"),
+        "bytes": importer.total_bytes,
+        "items": importer.result(),
+    }
+    if error:
+        body["error"] = error
+    return jsonify(body), status
+
+# ──────────────────────────────
+# WARDROBE INDEXER
+# ──────────────────────────────
+# `flask index-wardrobe DIR MANIFEST` analyses a directory tree of images on
+# every core with the same code and analysis cache as the upload endpoints.
+# Each result is appended to MANIFEST (JSON lines) as soon as it is ready, so
+# an interrupted run resumes where it stopped: files whose path, size and
+# mtime are already in the manifest without an error are skipped.
+# `flask load-wardrobe MANIFEST [SID]` then stores the images and adds them
+# to a wardrobe (a new one unless SID is given) without analysing anything
+# again, and prints a signed /wardrobe/<token> link: opening it switches the
+# browser session to that wardrobe.
+#
+# The item type comes from the first directory level under DIR ("tops",
+# "bottoms" or "faces"), unless --type is given; faces get detect_skin_tone.
+INDEX_FOLDERS = {"tops": "tops", "bottoms": "bottoms", "faces": "faces", "face": "faces"}
+INDEX_PROGRESS_SECONDS = 2.0
+
+def index_file(path, kind):
+    # Runs in an indexer process; returns one manifest row
+    field, fn, fallback = ANALYZERS[kind]
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        data = f.read()
+    digest = content_hash(data)
+    read_ms = (time.perf_counter() - start) * 1e3
+    row = {"hash": digest, "bytes": len(data), "read_ms": round(read_ms, 2)}
+    start = time.perf_counter()
+    result = cache_lookup(kind, digest)
+    row["cached"] = result is not None
+    try:
+        if result is None:
+            result = fn(data)
+            cache_store(kind, digest, result)
+    except Exception as e:
+        result, row["error"] = fallback, str(e) or type(e).__name__
+    row[field] = result
+    row["analyze_ms"] = round((time.perf_counter() - start) * 1e3, 2)
+    return row
+
+def _fingerprint(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+def read_manifest(path):
+    # {path: row} for the last row of every path; a torn last line is ignored
+    rows = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue
+                rows[row["path"]] = row
+    return rows
+
+def scan_images(root, item_type=None):
+    # [(path, item type)] sorted by path
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        for name in sorted(filenames):
+            if os.path.splitext(name)[1].lower() not in IMAGE_EXTENSIONS:
+                continue
+            path = os.path.join(dirpath, name)
+            kind = item_type
+            if kind is None:
+                top = os.path.relpath(path, root).split(os.sep)[0]
+                kind = INDEX_FOLDERS.get(top.lower())
+            if kind is not None:
+                found.append((os.path.abspath(path), kind))
+    return found
+
+@app.cli.command("index-wardrobe")
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+@click.argument("manifest", type=click.Path(dir_okay=False))
+@click.option("--type", "item_type", type=click.Choice(["tops", "bottoms", "faces"]),
+              help="Treat every image as this type instead of using the first directory level.")
+@click.option("--workers", type=int, default=_cores, show_default=True, help="Analysis processes.")
+def index_wardrobe(directory, manifest, item_type, workers):
+    """Analyse every image under DIRECTORY and append the results to MANIFEST."""
+    done = read_manifest(manifest)
+    todo, skipped = [], 0
+    for path, kind in scan_images(directory, item_type):
+        row = done.get(path)
+        fingerprint = _fingerprint(path)
+        if row and "error" not in row and (row["size"], row["mtime_ns"]) == fingerprint:
+            skipped += 1
+        else:
+            todo.append((path, kind, fingerprint))
+    click.echo(f"{len(todo)} images to index, {skipped} already in {manifest}")
+    if not todo:
+        return
+
+    start = last = time.monotonic()
+    indexed = errors = total_bytes = 0
+    with open(manifest, "a") as out, ProcessPoolExecutor(
+            max_workers=max(workers, 1), initializer=_init_analysis_process,
+            mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {pool.submit(index_file, path, "skin" if kind == "faces" else "color"): (path, kind, fp)
+                   for path, kind, fp in todo}
+        for future in as_completed(futures):
+            path, kind, (size, mtime_ns) = futures[future]
+            try:
+                row = future.result()
+            except Exception as e:
+                row = {"error": str(e) or type(e).__name__}
+            row = {"path": path, "type": kind, "size": size, "mtime_ns": mtime_ns, **row}
+            out.write(json.dumps(row) + "\n")
+            out.flush()
+            indexed += 1
+            errors += "error" in row
+            total_bytes += row.get("bytes", 0)
+            now = time.monotonic()
+            if now - last >= INDEX_PROGRESS_SECONDS or indexed == len(todo):
+                last = now
+                elapsed = now - start
+                click.echo(f"{indexed}/{len(todo)} images, {indexed / elapsed:.1f}/s, "
+                           f"{total_bytes / elapsed / 1e6:.1f} MB/s, {errors} errors", err=True)
+    click.echo(f"Indexed {indexed} images in {time.monotonic() - start:.1f}s ({errors} errors)")
+
+def load_manifest(manifest, sid, batch=256):
+    # Stores every garment in a manifest and adds it to sid's wardrobe;
+    # returns {item type: count}. Faces and failed rows are skipped.
+    loaded = defaultdict(int)
+    pending = defaultdict(list)
+
+    def flush(item_type):
+        wardrobe.add_items(sid, item_type, pending[item_type])
+        loaded[item_type] += len(pending[item_type])
+        pending[item_type] = []
+
+    try:
+        for row in read_manifest(manifest).values():
+            if row.get("type") not in ITEM_TYPES or "error" in row or "color" not in row:
+                continue
+            with open(row["path"], "rb") as f:
+                data = f.read()
+            path = uploads.put(sid, data, row["path"], row["hash"])
+            pending[row["type"]].append({"path": path, "color": row["color"]})
+            if len(pending[row["type"]]) >= batch:
+                flush(row["type"])
+    finally:
+        # Whatever was stored before a failure still lands in the wardrobe
+        for item_type in ITEM_TYPES:
+            if pending[item_type]:
+                flush(item_type)
+    return dict(loaded)
+
+WARDROBE_LINK_MAX_AGE = 7 * 24 * 3600
+
+def wardrobe_links():
+    return URLSafeTimedSerializer(app.secret_key, salt="wardrobe-link")
+
+@app.route('/wardrobe/<token>', methods=['GET'])
+def adopt_wardrobe(token):
+    try:
+        sid = wardrobe_links().loads(token, max_age=WARDROBE_LINK_MAX_AGE)
+    except BadSignature:
+        return jsonify({"error": "invalid or expired wardrobe link"}), 400
+    session['sid'] = sid
+    session.pop('jobs', None)   # they belong to the previous wardrobe
+    return redirect(url_for('home'))
+
+@app.cli.command("load-wardrobe")
+@click.argument("manifest", type=click.Path(exists=True, dir_okay=False))
+@click.argument("sid", required=False)
+def load_wardrobe(manifest, sid):
+    """Copy the garments in MANIFEST into the upload store and SID's wardrobe (a new one if omitted)."""
+    sid = sid or uuid.uuid4().hex
+    with app.app_context():
+        try:
+            loaded = load_manifest(manifest, sid)
+        except StorageQuotaExceeded as e:
+            raise click.ClickException(str(e))
+    click.echo(", ".join(f"{n} {t}" for t, n in loaded.items()) or "Nothing to load")
+    with app.test_request_context():
+        link = url_for('adopt_wardrobe', token=wardrobe_links().dumps(sid))
+    click.echo(f"Wardrobe {sid}: open {link} within {WARDROBE_LINK_MAX_AGE // 86400} days to use it")
 
 # ──────────────────────────────
 # FULL ORIGINAL HTML (UNCHANGED)
@@ -592,9 +2977,139 @@ function generateRecommendations() {
 </html>
 """
 
+# ──────────────────────────────
+# PREBUILT PAGE
+# ──────────────────────────────
+# Nothing in HTML varies per request, so it is rendered once at startup and
+# kept as identity, gzip and (if the optional `brotli` package is installed)
+# brotli bodies with a content ETag. SPLIT_ASSETS=1 also moves the inline
+# CSS/JS into content-hashed files under /assets/ that browsers cache forever.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+app.config['SPLIT_ASSETS'] = os.environ.get("SPLIT_ASSETS") == "1"
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+def prebuild(body, mimetype):
+    body = body.encode() if isinstance(body, str) else body
+    variants = {"identity": body, "gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(body, quality=11)
+    return {"mimetype": mimetype, "etag": hashlib.sha256(body).hexdigest()[:20], "variants": variants}
+
+def build_page(html, split_assets=False):
+    # Returns (page, {asset name: prebuilt asset})
+    assets = {}
+    if split_assets:
+        for tag, ext, mimetype, link in (
+                ("style", "css", "text/css", '<link rel="stylesheet" href="/assets/{}">'),
+                ("script", "js", "text/javascript", '<script src="/assets/{}"></script>')):
+            start, end = html.index(f"<{tag}>"), html.index(f"</{tag}>")
+            asset = prebuild(html[start + len(tag) + 2:end], mimetype)
+            name = f"app.{asset['etag'][:12]}.{ext}"
+            assets[name] = asset
+            html = html[:start] + link.format(name) + html[end + len(tag) + 3:]
+    return prebuild(html, "text/html"), assets
+
+def send_prebuilt(asset, max_age=None):
+    encodings = request.accept_encodings
+    encoding = next((e for e in ("br", "gzip") if e in asset["variants"] and encodings[e]), "identity")
+    etag = f"{asset['etag']}-{encoding}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(asset["variants"][encoding], mimetype=asset["mimetype"])
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+    response.set_etag(etag)
+    response.vary.add("Accept-Encoding")
+    if max_age is None:
+        response.cache_control.no_cache = True
+    else:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+        response.cache_control.immutable = True
+    return response
+
+with app.app_context():
+    PAGE, PAGE_ASSETS = build_page(render_template_string(HTML), app.config['SPLIT_ASSETS'])
+
 @app.route("/", methods=["GET"])
 def home():
-    return render_template_string(HTML)
+    return send_prebuilt(PAGE)
+
+@app.route("/assets/<name>", methods=["GET"])
+def page_asset(name):
+    if name not in PAGE_ASSETS:
+        abort(404)
+    return send_prebuilt(PAGE_ASSETS[name], max_age=IMMUTABLE_MAX_AGE)
+
+@app.cli.command("build-page")
+@click.argument("out_dir", default="build")
+@click.option("--split-assets/--inline-assets", default=True, show_default=True)
+def build_page_command(out_dir, split_assets):
+    """Write the landing page (plus .gz/.br variants) for a static web server or CDN."""
+    with app.app_context():
+        page, assets = build_page(render_template_string(HTML), split_assets)
+    os.makedirs(os.path.join(out_dir, "assets"), exist_ok=True)
+    suffixes = {"identity": "", "gzip": ".gz", "br": ".br"}
+    for path, asset in [("index.html", page)] + [(os.path.join("assets", n), a) for n, a in assets.items()]:
+        for encoding, body in asset["variants"].items():
+            write_file(os.path.join(out_dir, path + suffixes[encoding]), body)
+    click.echo(f"Wrote index.html and {len(assets)} assets to {out_dir}/")
+
+# ──────────────────────────────
+# PRELOADED SERVERS
+# ──────────────────────────────
+# With gunicorn's preload_app (see gunicorn.conf.py) the master imports this
+# module once and forks the workers from it. freeze_reference_data() prepares
+# the read-only reference data for sharing: the NumPy tables are swapped for
+# read-only memory maps of .npy files (file-backed pages every worker shares,
+# and which nothing can dirty by accident), lazily built tables are built
+# now, and gc.freeze() keeps the collector from writing to every object's
+# header after the fork. warm_up() runs one throwaway analysis so decoder,
+# encoder and OpenCV initialisation is not paid by a user's request.
+REFERENCE_DIR = os.environ.get("REFERENCE_DIR", os.path.join(tempfile.gettempdir(), "chameleon-reference"))
+REFERENCE_ARRAYS = ("COLOR_REFS", "SANZO_BGR", "SANZO_LAB", "COLOR_LUT", "SANZO_LUT")
+
+def map_array(array, name):
+    # Read-only memory map of `array`, saved once under its content hash
+    digest = hashlib.sha256(array.tobytes() + str((array.dtype, array.shape)).encode()).hexdigest()[:16]
+    path = os.path.join(REFERENCE_DIR, f"{name}-{digest}.npy")
+    if not os.path.exists(path):
+        os.makedirs(REFERENCE_DIR, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, np.ascontiguousarray(array))
+        os.replace(tmp, path)
+    return np.load(path, mmap_mode="r")
+
+def freeze_reference_data():
+    # Returns {"mapped_bytes": ..., "frozen_objects": ...}
+    face_detector()
+    color_codes(COLOR_NAMES + SANZO_NAMES + ["Uncertain"])
+    mapped = 0
+    for name in REFERENCE_ARRAYS:
+        array = globals()[name]
+        if isinstance(array, np.ndarray) and array.size and not isinstance(array, np.memmap):
+            globals()[name] = map_array(array, name)
+            mapped += array.nbytes
+    gc.collect()
+    gc.freeze()
+    return {"mapped_bytes": mapped, "frozen_objects": gc.get_freeze_count()}
+
+def warm_up():
+    img = np.full((480, 640, 3), (90, 120, 160), np.uint8)
+    cv2.ellipse(img, (320, 240), (120, 160), 0, 0, 360, (120, 150, 200), -1)
+    data = cv2.imencode(".jpg", img)[1].tobytes()
+    with metrics_suspended():
+        detect_skin_tone(data)
+        dominant_color(data)
+        skin_brightness(load_image(data, (200, 200)), face=True)
+        for ext in (".webp", ".jpg"):
+            cv2.imencode(ext, img[:160, :160])
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
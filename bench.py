@@ -0,0 +1,210 @@
+"""Offline micro-benchmarks for the color analysis and pairing code in app.py.
+
+    python bench.py                                   # run everything, print a report
+    python bench.py --save bench_baseline.json        # also store the results
+    python bench.py --compare bench_baseline.json     # exit 1 on a p50 regression
+    python bench.py --quick -k pairings               # fewer repeats, only matching names
+
+Everything is synthetic: images are generated at 1 MP and 12 MP, wardrobes grow
+from 10 to 200 items per type, and the Sanzo dataset is a deterministic fixture,
+so runs need no network and no uploads folder contents.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import cv2
+import numpy as np
+
+_tmp = tempfile.mkdtemp(prefix="chameleon-bench-")
+os.environ.setdefault("CHAMELEON_DB", os.path.join(_tmp, "bench.db"))
+os.environ.setdefault("SANZO_CACHE", os.path.join(_tmp, "sanzo.json"))
+
+import app  # noqa: E402
+
+RESOLUTIONS = {"1mp": (1152, 864), "12mp": (4000, 3000)}
+WARDROBE_SIZES = (10, 50, 200)
+SKIN_BGR = (120, 150, 200)
+
+
+def fixture_sanzo(n_colors=157, n_palettes=348, seed=7):
+    # Names reuse the COLOR_DB families so substring matching behaves like the real data
+    rng = random.Random(seed)
+    words = list(app.COLOR_DB) + ["Pink", "Grey", "Ivory", "Violet", "Orange"]
+    colors = [{
+        "name": f"{rng.choice(['Pale', 'Deep', 'Dusky', 'Light', 'Warm'])} {rng.choice(words)} {i}",
+        "hex": "#%06x" % rng.randrange(1 << 24),
+        "combinations": rng.sample(range(1, n_palettes + 1), rng.randint(2, 6)),
+    } for i in range(n_colors)]
+    return json.dumps(colors).encode()
+
+
+def install_fixture_sanzo():
+    cache = app.build_sanzo_cache(fixture_sanzo(), "bench-fixture")
+    app.write_sanzo_cache(cache, os.environ["SANZO_CACHE"])
+    app.load_sanzo(os.environ["SANZO_CACHE"])
+    app.build_sanzo_index()
+    app.pair_score.cache_clear()
+
+
+def synthetic_jpeg(size, seed, skin=False):
+    # Smooth color fields plus sensor-like noise, so JPEG sizes are realistic
+    rng = np.random.default_rng(seed)
+    w, h = size
+    img = cv2.resize(rng.integers(0, 256, (6, 8, 3), dtype=np.uint8), (w, h), interpolation=cv2.INTER_CUBIC)
+    if skin:
+        cv2.ellipse(img, (w // 2, h // 2), (w // 5, h // 3), 0, 0, 360, SKIN_BGR, -1)
+    noise = rng.normal(0, 6, (h, w, 3))
+    img = np.clip(img + noise, 0, 255).astype(np.uint8)
+    ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return buf.tobytes()
+
+
+def synthetic_wardrobe(n, seed):
+    rng = random.Random(seed)
+    tops, bottoms = defaultdict(list), defaultdict(list)
+    for i in range(n):
+        tops[rng.choice(app.COLOR_NAMES)].append(f"uploads/top_{i}.jpg")
+        bottoms[rng.choice(app.COLOR_NAMES)].append(f"uploads/bottom_{i}.jpg")
+    return tops, bottoms
+
+
+def compact_items(tops, bottoms):
+    # The synthetic wardrobe as changes_since() rows, in upload order
+    items = []
+    for item_type, groups in (("tops", tops), ("bottoms", bottoms)):
+        paths = sorted(((p, c) for c, ps in groups.items() for p in ps),
+                       key=lambda pc: int(pc[0].rsplit("_", 1)[1].split(".")[0]))
+        items += [(len(items) + 1, item_type, color, path) for path, color in paths]
+    return items
+
+
+def measure(fn, repeat, budget, warmup=1):
+    # Per-call latencies in seconds; stops after `repeat` calls or `budget` seconds
+    for _ in range(warmup):
+        fn()
+    samples = []
+    deadline = time.perf_counter() + budget
+    while len(samples) < repeat and (len(samples) < 3 or time.perf_counter() < deadline):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def summarize(samples, units=1):
+    s = np.array(samples)
+    return {
+        "calls": len(s),
+        "mean_ms": float(s.mean() * 1e3),
+        "p50_ms": float(np.percentile(s, 50) * 1e3),
+        "p90_ms": float(np.percentile(s, 90) * 1e3),
+        "p99_ms": float(np.percentile(s, 99) * 1e3),
+        "per_sec": float(units * len(s) / s.sum()),
+    }
+
+
+def benchmarks():
+    # name -> (callable, units processed per call)
+    cases = {}
+    for label, size in RESOLUTIONS.items():
+        face = synthetic_jpeg(size, 1, skin=True)
+        garment = synthetic_jpeg(size, 2)
+        cases[f"detect_skin_tone[{label}]"] = (lambda data=face: app.detect_skin_tone(data), 1)
+        cases[f"dominant_color[{label}]"] = (lambda data=garment: app.dominant_color(data), 1)
+
+    pairs = [(a, b) for a in app.COLOR_NAMES + ["Uncertain"] for b in app.COLOR_NAMES + ["Uncertain"]]
+
+    def palette_cold():
+        app.build_sanzo_index()
+        for a, b in pairs:
+            app.find_best_sanzo_palette(a, b)
+
+    def palette_warm():
+        for a, b in pairs:
+            app.find_best_sanzo_palette(a, b)
+
+    cases["find_best_sanzo_palette[cold]"] = (palette_cold, len(pairs))
+    cases["find_best_sanzo_palette[warm]"] = (palette_warm, len(pairs))
+
+    for n in WARDROBE_SIZES:
+        items = compact_items(*synthetic_wardrobe(n, n))
+        total = app.CompactWardrobe().apply(items, []).layout("Fair").total
+
+        def all_pairings(i=items):
+            layout = app.CompactWardrobe().apply(i, []).layout("Fair")
+            return list(layout.pairings(0, layout.total, "Oval"))
+
+        cases[f"all_pairings[{n}x{n}]"] = (all_pairings, total)
+        cases[f"top_pairings[{n}x{n},k=20]"] = (
+            lambda i=items: list(app.CompactWardrobe().apply(i, []).layout("Fair", ranked=True).pairings(0, 20, "Oval")), 20)
+        cases[f"compact_pairings[{n}x{n},page=50]"] = (
+            lambda i=items: list(app.CompactWardrobe().apply(i, []).layout("Fair").pairings(0, 50, "Oval")), min(50, total))
+    return cases
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, stats in results.items():
+        base = baseline.get("results", {}).get(name)
+        if base is None:
+            continue
+        ratio = stats["p50_ms"] / base["p50_ms"] if base["p50_ms"] else 1.0
+        stats["vs_baseline"] = round(ratio, 3)
+        if ratio > 1 + threshold:
+            regressions.append((name, base["p50_ms"], stats["p50_ms"], ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-k", "--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--repeat", type=int, default=50, help="max calls per benchmark")
+    parser.add_argument("--budget", type=float, default=3.0, help="max seconds per benchmark")
+    parser.add_argument("--quick", action="store_true", help="shorthand for --repeat 10 --budget 0.5")
+    parser.add_argument("--save", metavar="JSON", help="write results as a baseline file")
+    parser.add_argument("--compare", metavar="JSON", help="baseline file to compare p50 latencies against")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed p50 slowdown vs. the baseline before failing (0.25 = 25%%)")
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.repeat, args.budget = 10, 0.5
+
+    cv2.setNumThreads(1)
+    install_fixture_sanzo()
+    results = {}
+    print(f"{'benchmark':40} {'calls':>6} {'p50 ms':>10} {'p90 ms':>10} {'p99 ms':>10} {'units/s':>12}")
+    with app.app.test_request_context():
+        for name, (fn, units) in benchmarks().items():
+            if args.filter not in name:
+                continue
+            stats = results[name] = summarize(measure(fn, args.repeat, args.budget), units)
+            print(f"{name:40} {stats['calls']:>6} {stats['p50_ms']:>10.3f} {stats['p90_ms']:>10.3f} "
+                  f"{stats['p99_ms']:>10.3f} {stats['per_sec']:>12.1f}")
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": sys.version.split()[0],
+                "opencv": cv2.__version__,
+                "numpy": np.__version__,
+                "results": results,
+            }, f, indent=2)
+        print(f"saved {args.save}")
+    for name, base, now, ratio in regressions:
+        print(f"REGRESSION {name}: p50 {base:.3f} ms -> {now:.3f} ms ({ratio:.2f}x)")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
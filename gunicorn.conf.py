@@ -0,0 +1,52 @@
+# Production server settings:
+#
+#     gunicorn -c gunicorn.conf.py app:app
+#
+# The app is imported once in the master (preload_app) and workers are forked
+# from it, so the Sanzo data, palette index, color LUTs and the prebuilt page
+# are shared copy-on-write instead of being rebuilt per worker. Environment:
+# PORT / BIND, WEB_CONCURRENCY (workers), GUNICORN_THREADS, GUNICORN_TIMEOUT.
+import os
+import shutil
+
+cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+bind = os.environ.get("BIND", f"0.0.0.0:{os.environ.get('PORT', '8000')}")
+workers = int(os.environ.get("WEB_CONCURRENCY", cores * 2 + 1))
+# Every worker gets its own spawned analysis pool, and app.py would size each
+# one to all cores. Split the cores between workers instead; once there are
+# at least as many workers as cores, workers analyse in their request threads
+# (ANALYSIS_WORKERS=0). Set before the preload, which reads it at import.
+os.environ.setdefault("ANALYSIS_WORKERS", str(max(1, cores // workers) if workers < cores else 0))
+# Threads keep SSE job streams and NDJSON responses from pinning a whole worker
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+preload_app = True
+# Recycled workers are forked from the preloaded master again, which is cheap
+max_requests = 5000
+max_requests_jitter = 500
+accesslog = "-"
+
+
+def on_starting(server):
+    # Snapshots left by a previous run's workers would be summed into /metrics
+    from app import METRICS_DIR
+    shutil.rmtree(METRICS_DIR, ignore_errors=True)
+
+
+def when_ready(server):
+    # Runs in the master after the preload, before the first worker is forked
+    import app
+    # A fresh deployment has no Sanzo cache yet; fetch it once here so every
+    # worker is forked with the data instead of fetching its own copy
+    app.ensure_sanzo(wait=True)
+    app.warm_up()
+    frozen = app.freeze_reference_data()
+    server.log.info("Reference data frozen: %(mapped_bytes)d bytes memory-mapped, "
+                    "%(frozen_objects)d objects moved out of the collector's reach", frozen)
+
+
+def post_worker_init(worker):
+    # OpenCV's thread pool and per-process state do not survive fork()
+    import app
+    app.warm_up()
@@ -0,0 +1,333 @@
+"""End-to-end load test: full user sessions against a local gunicorn.
+
+    python loadtest.py                                  # 20 users for 30 s, 2 workers x 4 threads
+    python loadtest.py --users 5,10,20,40 --duration 20 # step the load to find saturation
+    python loadtest.py --workers 4 --threads 8 --tops 20 --bottoms 20
+    python loadtest.py --url http://127.0.0.1:8000      # drive a server that is already running
+
+Every simulated user loops over fresh sessions of the real flow:
+save_face_shape -> upload_face -> upload_clothes (tops, then bottoms, in
+batches) -> generate. Images are synthetic JPEGs made up front; each upload
+gets a few random trailing bytes (ignored by decoders) so it has a new content
+hash and pays for analysis and storage like a real photo would, unless
+--reuse-images is given. The server runs from gunicorn.conf.py in a temporary
+directory (database, uploads, metrics), so nothing here touches local data.
+Reports p50/p95/p99 latency per endpoint, throughput, error rate and worker RSS.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import cv2
+import numpy as np
+import requests
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+FACE_SHAPES = ("Oval", "Square", "Diamond", "Rectangular")
+SKIN_BGR = (120, 150, 200)
+
+
+def synthetic_jpeg(size, seed, skin=False):
+    # Smooth color fields plus noise, like bench.synthetic_jpeg
+    rng = np.random.default_rng(seed)
+    w, h = size
+    img = cv2.resize(rng.integers(0, 256, (6, 8, 3), dtype=np.uint8), (w, h), interpolation=cv2.INTER_CUBIC)
+    if skin:
+        cv2.ellipse(img, (w // 2, h // 2), (w // 5, h // 3), 0, 0, 360, SKIN_BGR, -1)
+    img = np.clip(img + rng.normal(0, 6, (h, w, 3)), 0, 255).astype(np.uint8)
+    return cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+
+
+class ImagePool:
+    def __init__(self, size, garments=48, faces=8, reuse=False):
+        self.garments = [synthetic_jpeg(size, i) for i in range(garments)]
+        self.faces = [synthetic_jpeg(size, 10_000 + i, skin=True) for i in range(faces)]
+        self.reuse = reuse
+
+    def pick(self, images, rng):
+        data = rng.choice(images)
+        return data if self.reuse else data + rng.randbytes(16)
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list)   # endpoint -> [seconds]
+        self.errors = defaultdict(int)
+        self.bytes = defaultdict(int)
+        self.sessions = 0
+
+    def request(self, http, label, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = http.request(method, url, timeout=120, **kwargs)
+            ok = response.status_code < 400
+            size = len(response.content)
+        except requests.RequestException:
+            ok, size = False, 0
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.samples[label].append(elapsed)
+            self.bytes[label] += size
+            if not ok:
+                self.errors[label] += 1
+        return ok
+
+
+def run_session(base, recorder, images, args, rng):
+    http = requests.Session()
+    recorder.request(http, "save_face_shape", "POST", f"{base}/api/save_face_shape",
+                     json={"face_shape": rng.choice(FACE_SHAPES)})
+    recorder.request(http, "upload_face", "POST", f"{base}/api/upload_face",
+                     files={"file": ("face.jpg", images.pick(images.faces, rng), "image/jpeg")})
+    for item_type, count in (("tops", args.tops), ("bottoms", args.bottoms)):
+        for first in range(0, count, args.batch):
+            files = [("files", (f"{item_type}_{first + i}.jpg", images.pick(images.garments, rng), "image/jpeg"))
+                     for i in range(min(args.batch, count - first))]
+            recorder.request(http, "upload_clothes", "POST", f"{base}/api/upload_clothes",
+                             data={"type": item_type}, files=files)
+    for _ in range(args.generates):
+        recorder.request(http, "generate", "GET", f"{base}/api/generate", params={"limit": args.limit})
+    with recorder.lock:
+        recorder.sessions += 1
+
+
+def drive(base, users, duration, images, args):
+    recorder = Recorder()
+    deadline = time.monotonic() + duration
+
+    def user(seed):
+        rng = random.Random(seed)
+        while time.monotonic() < deadline:
+            run_session(base, recorder, images, args, rng)
+
+    threads = [threading.Thread(target=user, args=(users * 1000 + i,), daemon=True) for i in range(users)]
+    start = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return recorder, time.monotonic() - start
+
+
+def process_tree(pid):
+    # {pid: parent pid} for every descendant of pid
+    parents = {}
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            try:
+                with open(f"/proc/{name}/stat") as f:
+                    parents[int(name)] = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+    tree, frontier = {}, [pid]
+    while frontier:
+        parent = frontier.pop()
+        for child, ppid in parents.items():
+            if ppid == parent and child not in tree:
+                tree[child] = parent
+                frontier.append(child)
+    return tree
+
+
+def rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+class RssSampler(threading.Thread):
+    # Peak RSS per gunicorn worker and of the whole process tree (workers plus
+    # their analysis pool processes), sampled twice a second
+    def __init__(self, master):
+        super().__init__(daemon=True)
+        self.master = master
+        self.worker_peak = defaultdict(int)
+        self.tree_peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(0.5):
+            tree = process_tree(self.master)
+            rss = {pid: rss_kb(pid) for pid in tree}
+            for pid, parent in tree.items():
+                if parent == self.master:
+                    self.worker_peak[pid] = max(self.worker_peak[pid], rss[pid])
+            self.tree_peak = max(self.tree_peak, rss_kb(self.master) + sum(rss.values()))
+
+    def reset(self):
+        self.worker_peak.clear()
+        self.tree_peak = 0
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def write_fixture_sanzo(workdir, env):
+    # bench.py's deterministic Sanzo fixture, written by a child so this
+    # process never imports the app
+    path = os.path.join(workdir, "sanzo.json")
+    subprocess.run([sys.executable, "-c",
+                    "import sys, app, bench; "
+                    "app.write_sanzo_cache(app.build_sanzo_cache(bench.fixture_sanzo(), 'bench-fixture'), sys.argv[1])",
+                    path], cwd=workdir, env=dict(env, PYTHONPATH=ROOT), check=True, capture_output=True)
+    return path
+
+
+def start_server(workdir, args):
+    port = free_port()
+    env = dict(os.environ,
+               PORT=str(port), BIND=f"127.0.0.1:{port}",
+               WEB_CONCURRENCY=str(args.workers), GUNICORN_THREADS=str(args.threads),
+               CHAMELEON_DB=os.path.join(workdir, "chameleon.db"),
+               METRICS_DIR=os.path.join(workdir, "metrics"),
+               REFERENCE_DIR=os.path.join(workdir, "reference"))
+    sanzo = os.path.join(ROOT, "data", "sanzo.json")
+    env["SANZO_CACHE"] = sanzo if os.path.exists(sanzo) else write_fixture_sanzo(workdir, env)
+    log = open(os.path.join(workdir, "gunicorn.log"), "w")
+    server = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", os.path.join(ROOT, "gunicorn.conf.py"),
+                               "--pythonpath", ROOT, "app:app"], cwd=workdir, env=env, stdout=log, stderr=log)
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"gunicorn exited with {server.returncode}; see {log.name}")
+        try:
+            if requests.get(base + "/", timeout=1).ok:
+                return server, base
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    server.terminate()
+    raise SystemExit(f"gunicorn did not answer within 60 s; see {log.name}")
+
+
+def summarize(recorder, elapsed):
+    results = {}
+    for label, samples in sorted(recorder.samples.items()):
+        s = np.array(samples)
+        results[label] = {
+            "requests": len(s),
+            "errors": recorder.errors[label],
+            "p50_ms": float(np.percentile(s, 50) * 1e3),
+            "p95_ms": float(np.percentile(s, 95) * 1e3),
+            "p99_ms": float(np.percentile(s, 99) * 1e3),
+            "per_sec": len(s) / elapsed,
+            "kb_per_request": recorder.bytes[label] / len(s) / 1024,
+        }
+    total = sum(r["requests"] for r in results.values())
+    errors = sum(r["errors"] for r in results.values())
+    return {
+        "endpoints": results,
+        "requests": total,
+        "requests_per_sec": total / elapsed,
+        "sessions": recorder.sessions,
+        "sessions_per_sec": recorder.sessions / elapsed,
+        "error_rate": errors / total if total else 0.0,
+        "seconds": elapsed,
+    }
+
+
+def report(users, summary, sampler):
+    print(f"\n== {users} users, {summary['seconds']:.1f}s: {summary['requests_per_sec']:.1f} req/s, "
+          f"{summary['sessions_per_sec']:.2f} sessions/s, error rate {summary['error_rate']:.2%}")
+    print(f"{'endpoint':18} {'requests':>9} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+          f"{'req/s':>8} {'KB/req':>8}")
+    for label, r in summary["endpoints"].items():
+        print(f"{label:18} {r['requests']:>9} {r['errors']:>7} {r['p50_ms']:>9.1f} {r['p95_ms']:>9.1f} "
+              f"{r['p99_ms']:>9.1f} {r['per_sec']:>8.1f} {r['kb_per_request']:>8.1f}")
+    if sampler is not None and sampler.worker_peak:
+        peaks = sorted(sampler.worker_peak.values())
+        print(f"worker RSS peak: min {peaks[0] / 1024:.1f} MB, max {peaks[-1] / 1024:.1f} MB "
+              f"({len(peaks)} workers); server total peak {sampler.tree_peak / 1024:.1f} MB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", default="20", help="concurrent users; a comma list runs one step per value")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds per step")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn worker processes")
+    parser.add_argument("--threads", type=int, default=4, help="threads per gunicorn worker")
+    parser.add_argument("--tops", type=int, default=8, help="tops uploaded per session")
+    parser.add_argument("--bottoms", type=int, default=8, help="bottoms uploaded per session")
+    parser.add_argument("--batch", type=int, default=4, help="files per upload_clothes request")
+    parser.add_argument("--generates", type=int, default=2, help="generate calls per session")
+    parser.add_argument("--limit", type=int, default=50, help="pairings per generate call")
+    parser.add_argument("--image-size", default="1280x960", help="synthetic image size, WxH")
+    parser.add_argument("--reuse-images", action="store_true",
+                        help="upload identical bytes repeatedly (measures the analysis cache path)")
+    parser.add_argument("--url", help="use a running server instead of starting gunicorn (no RSS report)")
+    parser.add_argument("--save", metavar="JSON", help="write the results to a file")
+    args = parser.parse_args(argv)
+    steps = [int(u) for u in args.users.split(",")]
+    size = tuple(int(v) for v in args.image_size.lower().split("x"))
+
+    images = ImagePool(size, reuse=args.reuse_images)
+    workdir = server = sampler = None
+    if args.url:
+        base = args.url.rstrip("/")
+    else:
+        workdir = tempfile.mkdtemp(prefix="chameleon-load-")
+        server, base = start_server(workdir, args)
+        sampler = RssSampler(server.pid)
+        sampler.start()
+    print(f"target {base}; {args.workers} workers x {args.threads} threads" if server else f"target {base}")
+
+    results = []
+    try:
+        for users in steps:
+            if sampler is not None:
+                sampler.reset()
+            recorder, elapsed = drive(base, users, args.duration, images, args)
+            summary = summarize(recorder, elapsed)
+            report(users, summary, sampler)
+            if sampler is not None:
+                summary["worker_rss_peak_kb"] = dict(sampler.worker_peak)
+                summary["server_rss_peak_kb"] = sampler.tree_peak
+            results.append({"users": users, **summary})
+    finally:
+        if sampler is not None:
+            sampler.stop()
+        if server is not None:
+            server.send_signal(signal.SIGTERM)
+            try:
+                server.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                server.kill()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "config": {k: v for k, v in vars(args).items() if k != "save"},
+                "steps": results,
+            }, f, indent=2, default=str)
+        print(f"saved {args.save}")
+    return 1 if any(r["error_rate"] > 0 for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())